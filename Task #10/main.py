@@ -5,6 +5,14 @@ from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
+from collections import deque
+import asyncio
+import base64
+import bisect
+import heapq
+import json
+import math
+import re
 
 import jwtconfig
 
@@ -36,6 +44,18 @@ class UpdateIssue(BaseModel):
 class AssignIssue(BaseModel):
     assignee : str = None
 
+class BulkIssueChange(BaseModel):
+    id : int
+    status : Optional[str] = None
+    assignee : Optional[str] = None
+
+class BulkIssueUpdate(BaseModel):
+    changes : list[BulkIssueChange]
+
+class EditIssue(BaseModel):
+    title : Optional[str] = None
+    description : Optional[str] = None
+
 class IssueForm(BaseModel):
     title : str
     description : Optional[str] = None
@@ -83,6 +103,24 @@ db = {
     }
 }
 
+INDEXED_ISSUE_FIELDS = ("status", "reporter", "assignee")
+issue_indexes = {field : {} for field in INDEXED_ISSUE_FIELDS}
+ISSUE_SORT_FIELDS = ("id", "status", "updated_at")
+issue_orders = {field : [] for field in ISSUE_SORT_FIELDS}
+# field -> value -> sort -> sorted keys, so a filtered page is a bisect like an unfiltered one
+issue_filter_orders = {field : {} for field in INDEXED_ISSUE_FIELDS}
+TEXT_ISSUE_FIELDS = ("title", "description")
+TOKEN_PATTERN = re.compile(r"\w+")
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+MAX_PREFIX_EXPANSIONS = 100
+text_postings = {}
+text_lengths = {}
+text_vocabulary = []
+text_totals = {"length" : 0}
+CHANGE_LOG_SIZE = 10000
+MAX_CHANGES_WAIT_SECONDS = 60
+issue_changes = {"version" : 0, "log" : deque(maxlen=CHANGE_LOG_SIZE), "event" : asyncio.Event()}
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -94,6 +132,217 @@ def verify_password(plain_password : str, hashed_password : str) -> bool:
 def get_password_hash(password : str) -> str:
     return pwd_context.hash(password)
 
+def issue_sort_key(issue : dict, sort : str) -> tuple:
+    if sort == "id":
+        return (issue["id"],)
+    return (issue[sort], issue["id"])
+
+def index_issue(issue : dict):
+    for field in INDEXED_ISSUE_FIELDS:
+        issue_indexes[field].setdefault(issue[field], set()).add(issue["id"])
+        issue_filter_orders[field].setdefault(issue[field], {sort : [] for sort in ISSUE_SORT_FIELDS})
+    for sort in ISSUE_SORT_FIELDS:
+        key = issue_sort_key(issue, sort)
+        bisect.insort(issue_orders[sort], key)
+        for field in INDEXED_ISSUE_FIELDS:
+            bisect.insort(issue_filter_orders[field][issue[field]][sort], key)
+
+def unindex_issue(issue : dict):
+    for field in INDEXED_ISSUE_FIELDS:
+        postings = issue_indexes[field][issue[field]]
+        postings.discard(issue["id"])
+        if not postings:
+            del issue_indexes[field][issue[field]]
+            del issue_filter_orders[field][issue[field]]
+    for sort in ISSUE_SORT_FIELDS:
+        key = issue_sort_key(issue, sort)
+        order = issue_orders[sort]
+        del order[bisect.bisect_left(order, key)]
+        for field in INDEXED_ISSUE_FIELDS:
+            order = issue_filter_orders[field].get(issue[field], {}).get(sort)
+            if order:
+                del order[bisect.bisect_left(order, key)]
+
+def record_issue_change(issue : dict):
+    issue_changes["version"] += 1
+    issue["version"] = issue_changes["version"]
+    issue_changes["log"].append((issue_changes["version"], issue["id"]))
+    # Wake every long-poll waiter, later waiters block on a fresh event
+    issue_changes["event"].set()
+    issue_changes["event"] = asyncio.Event()
+
+def collect_issue_changes(since : int) -> Optional[list[dict]]:
+    log = issue_changes["log"]
+    # A version ahead of ours was issued before a restart, the client has to resync just like one that fell behind the log
+    if since > issue_changes["version"] or (log and since < log[0][0] - 1):
+        return None
+
+    changed = {}
+    for version, issue_id in reversed(log):
+        if version <= since:
+            break
+        changed.setdefault(issue_id, version)
+    return [db["issues"][issue_id] for issue_id in sorted(changed, key=changed.get)]
+
+def update_issue(issue : dict, **changes):
+    unindex_issue(issue)
+    reindex_text = any(field in changes for field in TEXT_ISSUE_FIELDS)
+    if reindex_text:
+        unindex_issue_text(issue)
+    issue.update(changes, updated_at=datetime.utcnow())
+    index_issue(issue)
+    if reindex_text:
+        index_issue_text(issue)
+    record_issue_change(issue)
+
+def tokenize(text : Optional[str]) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+def issue_tokens(issue : dict) -> list[str]:
+    tokens = []
+    for field in TEXT_ISSUE_FIELDS:
+        tokens += tokenize(issue[field])
+        # Leaves a position gap so phrases can't match across the title/description boundary
+        tokens.append(None)
+    return tokens
+
+def index_issue_text(issue : dict):
+    tokens = issue_tokens(issue)
+    for position, term in enumerate(tokens):
+        if term is None:
+            continue
+        if term not in text_postings:
+            text_postings[term] = {}
+            bisect.insort(text_vocabulary, term)
+        text_postings[term].setdefault(issue["id"], []).append(position)
+    text_lengths[issue["id"]] = len(tokens)
+    text_totals["length"] += len(tokens)
+
+def unindex_issue_text(issue : dict):
+    for term in set(issue_tokens(issue)) - {None}:
+        postings = text_postings[term]
+        postings.pop(issue["id"], None)
+        if not postings:
+            del text_postings[term]
+            del text_vocabulary[bisect.bisect_left(text_vocabulary, term)]
+    text_totals["length"] -= text_lengths.pop(issue["id"], 0)
+
+def match_term(term : str) -> dict[int, int]:
+    return {issue_id : len(positions) for issue_id, positions in text_postings.get(term, {}).items()}
+
+def match_prefix(prefix : str) -> dict[int, int]:
+    matches = {}
+    start = bisect.bisect_left(text_vocabulary, prefix)
+    for term in text_vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+        if not term.startswith(prefix):
+            break
+        for issue_id, positions in text_postings[term].items():
+            matches[issue_id] = matches.get(issue_id, 0) + len(positions)
+    return matches
+
+def match_phrase(terms : list[str]) -> dict[int, int]:
+    postings = [text_postings.get(term, {}) for term in terms]
+    candidates = min(postings, key=len)
+    matches = {}
+    for issue_id in candidates:
+        if not all(issue_id in posting for posting in postings):
+            continue
+        following = [set(posting[issue_id]) for posting in postings[1:]]
+        count = sum(
+            1 for start in postings[0][issue_id]
+            if all(start + offset + 1 in positions for offset, positions in enumerate(following))
+        )
+        if count:
+            matches[issue_id] = count
+    return matches
+
+def parse_search_query(query : str) -> list[dict[int, int]]:
+    clauses = []
+    for phrase, word in QUERY_PATTERN.findall(query):
+        if phrase:
+            terms = tokenize(phrase)
+            if terms:
+                clauses.append(match_term(terms[0]) if len(terms) == 1 else match_phrase(terms))
+        elif word.endswith("*") and tokenize(word):
+            clauses.append(match_prefix(word[:-1].lower()))
+        else:
+            clauses.extend(match_term(term) for term in tokenize(word))
+    return clauses
+
+def search_issues(query : str, filters : dict, limit : int) -> list[tuple[float, int]]:
+    clauses = parse_search_query(query)
+    if not clauses:
+        return []
+
+    # Every clause has to match; scoring is a BM25-style sum over clauses
+    clauses.sort(key=len)
+    restrictions = [issue_indexes[field].get(value, set()) for field, value in filters.items()]
+    issues_count = len(text_lengths)
+    average_length = text_totals["length"] / issues_count if issues_count else 1
+    scored = []
+    for issue_id in clauses[0]:
+        if not all(issue_id in clause for clause in clauses[1:]):
+            continue
+        if not all(issue_id in restriction for restriction in restrictions):
+            continue
+        norm = 1.2 * (0.25 + 0.75 * text_lengths[issue_id] / average_length)
+        score = 0.0
+        for clause in clauses:
+            idf = math.log(1 + (issues_count - len(clause) + 0.5) / (len(clause) + 0.5))
+            score += idf * clause[issue_id] * 2.2 / (clause[issue_id] + norm)
+        scored.append((score, issue_id))
+    return heapq.nlargest(limit, scored)
+
+def encode_issue_cursor(sort : str, key : tuple) -> str:
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps([sort, values]).encode()).decode()
+
+def is_issue_id(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def decode_issue_cursor(cursor : str, sort : str) -> tuple:
+    try:
+        cursor_sort, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if cursor_sort != sort or not isinstance(values, list):
+            raise ValueError("cursor was issued for another sort")
+        if sort == "id":
+            valid = len(values) == 1 and is_issue_id(values[0])
+        else:
+            valid = len(values) == 2 and isinstance(values[0], str) and is_issue_id(values[1])
+        if not valid:
+            raise ValueError("cursor values don't match the sort")
+        if sort == "updated_at":
+            values[0] = datetime.fromisoformat(values[0])
+        return tuple(values)
+    except (ValueError, TypeError, IndexError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+def plan_issue_query(filters : dict, sort : str, after : Optional[tuple], limit : int) -> tuple[list[tuple], bool]:
+    # Walk the ordered keys of the most selective filter from the cursor and probe the other postings,
+    # so a page costs about the same wherever it starts
+    keys = issue_orders[sort]
+    rest = []
+    if filters:
+        postings = sorted(filters.items(), key=lambda item: len(issue_indexes[item[0]].get(item[1], ())))
+        field, value = postings[0]
+        keys = issue_filter_orders[field].get(value, {}).get(sort, [])
+        rest = [issue_indexes[field].get(value, set()) for field, value in postings[1:]]
+
+    start = 0 if after is None else bisect.bisect_right(keys, after)
+    if sort in filters:
+        # Keys sharing the filtered sort value are contiguous, jump straight to them
+        start = max(start, bisect.bisect_left(keys, (filters[sort],)))
+    page = []
+    for position in range(start, len(keys)):
+        key = keys[position]
+        if sort in filters and key[0] != filters[sort]:
+            break
+        if all(key[-1] in posting for posting in rest):
+            if len(page) == limit:
+                return page, True
+            page.append(key)
+    return page, False
+
 def get_user(db, username : str) -> UserInDB:
     if username in db["users"]:
         user_data = db["users"][username]
@@ -192,23 +441,50 @@ async def create_new_issue(form : IssueForm, current_user : User = Depends(get_c
         "status": "open",
         "reporter": current_user.username,
         "assignee": form.assigne,
+        "updated_at": datetime.utcnow(),
     }
+    index_issue(db["issues"][issueID])
+    index_issue_text(db["issues"][issueID])
+    record_issue_change(db["issues"][issueID])
 
     return {"message" : "succesfully added issue"}
 
 @app.get("/issues")
-async def get_all_issues(status: Optional[str] = Query(None), reporter: Optional[str] = Query(None), assignee: Optional[str] = Query(None)):
-    issues = db["issues"]
-    result = []
-    for issue in issues:
-        if status is not None and issue["status"] != status:
-            continue
-        if reporter is not None and issue["reporter"] != reporter:
-            continue
-        if assignee is not None and issue["assignee"] != assignee:
-            continue
-        result.append(issue)
-    return result
+async def get_all_issues(status: Optional[str] = Query(None), reporter: Optional[str] = Query(None), assignee: Optional[str] = Query(None),
+                         sort: str = Query("id"), limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = Query(None)):
+    if sort not in ISSUE_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Sort must be one of {list(ISSUE_SORT_FIELDS)}")
+
+    filters = {"status" : status, "reporter" : reporter, "assignee" : assignee}
+    filters = {field : value for field, value in filters.items() if value is not None}
+    after = None if cursor is None else decode_issue_cursor(cursor, sort)
+    page, has_more = plan_issue_query(filters, sort, after, limit)
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_issue_cursor(sort, page[-1])
+    return {"issues" : [db["issues"][key[-1]] for key in page], "next_cursor" : next_cursor}
+
+@app.get("/issues/search")
+async def search_all_issues(q : str = Query(..., min_length=1), status : Optional[str] = Query(None), assignee : Optional[str] = Query(None), limit : int = Query(20, ge=1, le=100)):
+    filters = {"status" : status, "assignee" : assignee}
+    filters = {field : value for field, value in filters.items() if value is not None}
+    return [dict(db["issues"][issue_id], score=round(score, 4)) for score, issue_id in search_issues(q, filters, limit)]
+
+@app.get("/issues/changes")
+async def get_issue_changes(since : int = Query(0, ge=0), timeout : float = Query(0, ge=0, le=MAX_CHANGES_WAIT_SECONDS)):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        changes = collect_issue_changes(since)
+        if changes is None:
+            return {"version" : issue_changes["version"], "resync" : True, "changes" : []}
+        remaining = deadline - loop.time()
+        if changes or remaining <= 0:
+            return {"version" : issue_changes["version"], "resync" : False, "changes" : changes}
+        try:
+            await asyncio.wait_for(issue_changes["event"].wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
 
 @app.get("/issues/{id}")
 async def get_issue_by_id(id : int):
@@ -217,6 +493,49 @@ async def get_issue_by_id(id : int):
     
     return db["issues"][id]
 
+@app.put("/issues/bulk")
+async def bulk_update_issues(form : BulkIssueUpdate, current_user : User = Depends(get_current_active_user)):
+    # Validate everything against a simulated view of the touched issues before writing anything
+    pending = {}
+    developers = {}
+    errors = []
+    for change in form.changes:
+        if change.id not in db["issues"]:
+            errors.append({"id" : change.id, "error" : f"Not found isssue with id {change.id}"})
+            continue
+        if change.status is None and change.assignee is None:
+            errors.append({"id" : change.id, "error" : "Not provided status or assignee"})
+            continue
+
+        state = pending.setdefault(change.id, {"assignee" : db["issues"][change.id]["assignee"]})
+        if change.assignee is not None:
+            if change.assignee not in developers:
+                user_data = db["users"].get(change.assignee)
+                developers[change.assignee] = user_data is not None and user_data["role"] == "developer"
+            if not developers[change.assignee]:
+                errors.append({"id" : change.id, "error" : f"User {change.assignee} is not a developer"})
+                continue
+            self_assign = change.assignee == current_user.username and state["assignee"] is None
+            if current_user.role != "admin" and not (current_user.role == "developer" and self_assign):
+                errors.append({"id" : change.id, "error" : "User is not allowed to assign this"})
+                continue
+            state["assignee"] = change.assignee
+
+        if change.status is not None:
+            if state["assignee"] != current_user.username:
+                errors.append({"id" : change.id, "error" : "User is not allowed to edit this"})
+                continue
+            state["status"] = change.status
+
+    if errors:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=errors)
+
+    results = []
+    for issue_id, state in pending.items():
+        update_issue(db["issues"][issue_id], **state)
+        results.append({"id" : issue_id, "status" : db["issues"][issue_id]["status"], "assignee" : db["issues"][issue_id]["assignee"]})
+    return {"message" : "succesfully updated issues", "issues" : results}
+
 @app.put("/issues/{id}")
 async def update_issue_status(id : int, form : UpdateIssue, current_user : User = Depends(get_current_active_user)):
     if id not in db["issues"]:
@@ -224,10 +543,26 @@ async def update_issue_status(id : int, form : UpdateIssue, current_user : User
     
     if db["issues"][id]["assignee"] != current_user.username:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is not allowed to edit this")
+
+    if form.status is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Not provided status")
     
-    db["issues"][id]["status"] = form.status
+    update_issue(db["issues"][id], status=form.status)
     return {"message" : "succesfully updated status"}
 
+@app.patch("/issues/{id}")
+async def edit_issue(id : int, form : EditIssue, current_user : User = Depends(get_current_active_user)):
+    if id not in db["issues"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Not found isssue with id {id}")
+
+    if db["issues"][id]["reporter"] != current_user.username:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is not allowed to edit this")
+
+    changes = {field : value for field, value in form.dict().items() if value is not None}
+    if changes:
+        update_issue(db["issues"][id], **changes)
+    return {"message" : "succesfully updated issue"}
+
 @app.put("/issues/{id}/assign")
 async def assign_issue(id : int, form : Optional[AssignIssue] = None, current_user : User = Depends(get_current_active_user)):
     if id not in db["issues"]:
@@ -235,13 +570,17 @@ async def assign_issue(id : int, form : Optional[AssignIssue] = None, current_us
     
     if form is not None and current_user.role == "admin":
         if form.assignee in db["users"] and db["users"][form.assignee]["role"] == "developer":
-            db["issues"][id]["assignee"] = form.assignee
+            update_issue(db["issues"][id], assignee=form.assignee)
             return {"message" : "succesfully updated assignee"}
     else:
         if current_user.role == "developer" and db["issues"][id]["assignee"] == None:
-            db["issues"][id]["assignee"] = current_user.username
+            update_issue(db["issues"][id], assignee=current_user.username)
             return {"message" : "succesfully updated assignee"}
         
-    raise HTTPException(status_code=status.HTTP400, detail=f"Issue with user request")
-    
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Issue with user request")
 
+for issue in db["issues"].values():
+    issue.setdefault("updated_at", datetime.utcnow())
+    index_issue(issue)
+    index_issue_text(issue)
+    record_issue_change(issue)
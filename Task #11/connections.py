@@ -0,0 +1,46 @@
+# === Connections File ===
+import asyncio
+from fastapi import WebSocket, status
+
+SEND_QUEUE_SIZE = 256
+
+class Connection:
+    def __init__(self, websocket: WebSocket, username: str):
+        self.websocket = websocket
+        self.username = username
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+
+    async def send_forever(self):
+        while True:
+            payload = await self.queue.get()
+            await self.websocket.send_json(payload)
+
+class ConnectionRegistry:
+    def __init__(self):
+        self.connections: dict[str, set[Connection]] = {}
+
+    def register(self, connection: Connection):
+        self.connections.setdefault(connection.username, set()).add(connection)
+
+    def unregister(self, connection: Connection):
+        sessions = self.connections.get(connection.username)
+        if sessions is None:
+            return
+        sessions.discard(connection)
+        if not sessions:
+            del self.connections[connection.username]
+
+    def push(self, username: str, payload: dict):
+        for connection in list(self.connections.get(username, ())):
+            self.send(connection, payload)
+
+    def send(self, connection: Connection, payload: dict):
+        try:
+            connection.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.disconnect_slow_consumer(connection)
+
+    def disconnect_slow_consumer(self, connection: Connection):
+        # A full queue means the client stopped reading, drop it instead of buffering without bound
+        self.unregister(connection)
+        asyncio.create_task(connection.websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Slow consumer"))
@@ -1,12 +1,17 @@
 # === Main File ===
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, Query, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
+import asyncio
+import bisect
 
 from models import *
 from jwtconfig import *
+from connections import *
+from message_store import MessageStore
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -14,9 +19,18 @@ app = FastAPI()
 
 db = {
     "users": {},
-    "messages": {},
+    "messages": MessageStore(),
+    "inbox": {},
+    "outbox": {},
+    "conversations": {},
+    "user_conversations": {},
+    "rooms": {},
+    "user_rooms": {},
+    "room_messages": MessageStore(),
 }
 
+registry = ConnectionRegistry()
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -34,6 +48,111 @@ def authenticate_user(db, username: str, password: str) -> Optional[UserInDB]:
         return None
     return user
 
+def page_message_ids(ids: list[int], limit: int, before_id: Optional[int]) -> list[int]:
+    # Ids are appended in increasing order, so a page is a bisect plus a slice, newest first
+    end = len(ids) if before_id is None else bisect.bisect_left(ids, before_id)
+    return ids[max(0, end - limit):end][::-1]
+
+def remove_message_id(ids: list[int], message_id: int):
+    position = bisect.bisect_left(ids, message_id)
+    if position < len(ids) and ids[position] == message_id:
+        del ids[position]
+
+def conversation_key(first: str, second: str) -> tuple[str, str]:
+    return tuple(sorted((first, second)))
+
+def add_to_conversation(message: Message):
+    key = conversation_key(message.sender, message.receiver)
+    conversation = db["conversations"].setdefault(key, {
+        "messages": [],
+        "received": {username: [] for username in key},
+        "unread": {username: 0 for username in key},
+        "read_watermark": {username: 0 for username in key},
+        "read_above_watermark": {username: [] for username in key},
+        "last_activity": None,
+    })
+    conversation["messages"].append(message.id)
+    conversation["received"][message.receiver].append(message.id)
+    conversation["unread"][message.receiver] += 1
+    conversation["last_activity"] = message.timestamp
+    # Re-inserting moves the conversation to the end, so each user's dict stays ordered by activity
+    for username, peer in ((message.sender, message.receiver), (message.receiver, message.sender)):
+        user_conversations = db["user_conversations"].setdefault(username, {})
+        user_conversations.pop(peer, None)
+        user_conversations[peer] = key
+
+def is_message_read(message_id: int) -> bool:
+    # Everything up to the receiver's conversation watermark is read, above it the store's read bit decides
+    messages = db["messages"]
+    receiver = messages.receiver(message_id)
+    conversation = db["conversations"][conversation_key(messages.sender(message_id), receiver)]
+    return message_id <= conversation["read_watermark"][receiver] or messages.is_read(message_id)
+
+def serialize_message(message_id: int) -> dict:
+    message = db["messages"][message_id]
+    message["is_read"] = is_message_read(message_id)
+    return message
+
+def mark_message_read(message_id: int, username: str):
+    messages = db["messages"]
+    if message_id not in messages:
+        raise HTTPException(status_code=404, detail="Message not found")
+    if messages.receiver(message_id) != username:
+        raise HTTPException(status_code=403, detail="Not authorized to read this message")
+    sender = messages.sender(message_id)
+    if not is_message_read(message_id):
+        conversation = db["conversations"][conversation_key(sender, username)]
+        bisect.insort(conversation["read_above_watermark"][username], message_id)
+        conversation["unread"][username] -= 1
+        messages.mark_read(message_id)
+    registry.push(sender, {"type": "read", "id": message_id, "reader": username})
+
+def advance_read_watermark(username: str, peer: str, up_to_id: Optional[int] = None) -> int:
+    conversation = db["conversations"].get(conversation_key(username, peer))
+    if conversation is None:
+        raise HTTPException(status_code=404, detail=f"No conversation with {peer}")
+
+    received = conversation["received"][username]
+    watermark = conversation["read_watermark"][username]
+    target = received[-1] if received else 0
+    if up_to_id is not None:
+        target = min(target, up_to_id)
+    if target <= watermark:
+        return watermark
+
+    newly_read = bisect.bisect_right(received, target) - bisect.bisect_right(received, watermark)
+    read_above = conversation["read_above_watermark"][username]
+    already_read = bisect.bisect_right(read_above, target)
+    del read_above[:already_read]
+    conversation["unread"][username] -= newly_read - already_read
+    conversation["read_watermark"][username] = target
+    registry.push(peer, {"type": "read_up_to", "up_to_id": target, "reader": username})
+    return target
+
+def get_room_for_member(room_id: int, username: str) -> dict:
+    room = db["rooms"].get(room_id)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    if username not in room["members"]:
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    return room
+
+def room_unread_count(room: dict, username: str) -> int:
+    # Members keep a read cursor, the unread count is the room message ids above it minus their own posts up there
+    above_cursor = len(room["messages"]) - bisect.bisect_right(room["messages"], room["members"][username])
+    return above_cursor - len(room["own_above_cursor"][username])
+
+def add_room_member(room: dict, username: str):
+    if username in room["members"]:
+        return
+    room["members"][username] = room["messages"][-1] if room["messages"] else 0
+    room["own_above_cursor"][username] = []
+    db["user_rooms"].setdefault(username, set()).add(room["id"])
+
+def serialize_room_message(room_id: int, message_id: int) -> dict:
+    message = db["room_messages"][message_id]
+    return {"id": message_id, "room_id": room_id, "sender": message["sender"], "text": message["text"], "timestamp": message["timestamp"]}
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=15))
@@ -98,7 +217,7 @@ async def register_new_user(form: UserRegister):
 
 @app.post("/messages")
 async def send_message(message_form: MessageForm, current_user: User = Depends(get_current_active_user)):
-    message_id = max(db["messages"].keys(), default=0) + 1
+    message_id = db["messages"].next_id()
     message = Message(
         id=message_id,
         sender=current_user.username,
@@ -106,25 +225,209 @@ async def send_message(message_form: MessageForm, current_user: User = Depends(g
         text=message_form.text,
         is_read=False
     )
-    db["messages"][message_id] = message.dict()
+    db["messages"].add(message.sender, message.receiver, message.text, message.timestamp)
+    db["inbox"].setdefault(message.receiver, []).append(message_id)
+    db["outbox"].setdefault(message.sender, []).append(message_id)
+    add_to_conversation(message)
+    registry.push(message.receiver, {"type": "message", "message": jsonable_encoder(serialize_message(message_id))})
     return {"message": "Successfully sent message"}
 
 @app.get("/messages/inbox")
-async def get_received_messages(current_user: User = Depends(get_current_active_user)):
-    username = current_user.username
-    return [msg for msg in db["messages"].values() if msg["receiver"] == username]
+async def get_received_messages(limit: int = Query(50, ge=1, le=500), before_id: Optional[int] = None, current_user: User = Depends(get_current_active_user)):
+    ids = db["inbox"].get(current_user.username, [])
+    return [serialize_message(message_id) for message_id in page_message_ids(ids, limit, before_id)]
 
 @app.get("/messages/sent")
-async def get_sent_messages(current_user: User = Depends(get_current_active_user)):
+async def get_sent_messages(limit: int = Query(50, ge=1, le=500), before_id: Optional[int] = None, current_user: User = Depends(get_current_active_user)):
+    ids = db["outbox"].get(current_user.username, [])
+    return [serialize_message(message_id) for message_id in page_message_ids(ids, limit, before_id)]
+
+@app.put("/messages/read")
+async def read_messages_bulk(form: ReadMarkForm, current_user: User = Depends(get_current_active_user)):
     username = current_user.username
-    return [msg for msg in db["messages"].values() if msg["sender"] == username]
+    modes = [form.ids is not None, form.peer is not None, form.all]
+    if sum(modes) != 1:
+        raise HTTPException(status_code=400, detail="Provide exactly one of ids, peer or all")
+
+    if form.all:
+        watermarks = {peer: advance_read_watermark(username, peer) for peer in db["user_conversations"].get(username, {})}
+        return {"message": "Successfully marked as read", "watermarks": watermarks}
+    if form.peer is not None:
+        watermark = advance_read_watermark(username, form.peer, form.up_to_id)
+        return {"message": "Successfully marked as read", "watermarks": {form.peer: watermark}}
+
+    results = {}
+    for message_id in form.ids:
+        try:
+            mark_message_read(message_id, username)
+            results[message_id] = "read"
+        except HTTPException as exc:
+            results[message_id] = exc.detail
+    return {"message": "Successfully marked as read", "results": results}
 
 @app.put("/messages/{id}/read")
 async def read_message(id: int, current_user: User = Depends(get_current_active_user)):
-    message = db["messages"].get(id)
-    if not message:
-        raise HTTPException(status_code=404, detail="Message not found")
-    if message["receiver"] != current_user.username:
-        raise HTTPException(status_code=403, detail="Not authorized to read this message")
-    message["is_read"] = True
+    mark_message_read(id, current_user.username)
     return {"message": "Successfully marked as read"}
+
+@app.delete("/messages/{id}")
+async def delete_message(id: int, current_user: User = Depends(get_current_active_user)):
+    messages = db["messages"]
+    if id not in messages:
+        raise HTTPException(status_code=404, detail="Message not found")
+    sender, receiver = messages.sender(id), messages.receiver(id)
+    if sender != current_user.username:
+        raise HTTPException(status_code=403, detail="Not authorized to delete this message")
+    conversation = db["conversations"][conversation_key(sender, receiver)]
+    if not is_message_read(id):
+        conversation["unread"][receiver] -= 1
+    del messages[id]
+    remove_message_id(db["inbox"][receiver], id)
+    remove_message_id(db["outbox"][sender], id)
+    remove_message_id(conversation["messages"], id)
+    remove_message_id(conversation["received"][receiver], id)
+    remove_message_id(conversation["read_above_watermark"][receiver], id)
+    return {"message": "Successfully deleted message"}
+
+@app.get("/conversations")
+async def get_conversations(limit: int = Query(50, ge=1, le=500), current_user: User = Depends(get_current_active_user)):
+    username = current_user.username
+    result = []
+    for peer, key in reversed(db["user_conversations"].get(username, {}).items()):
+        if len(result) >= limit:
+            break
+        conversation = db["conversations"][key]
+        last_message = serialize_message(conversation["messages"][-1]) if conversation["messages"] else None
+        result.append({
+            "peer": peer,
+            "last_activity": conversation["last_activity"],
+            "unread": conversation["unread"][username],
+            "last_message": last_message,
+        })
+    return result
+
+@app.get("/conversations/{peer}")
+async def get_conversation_messages(peer: str, limit: int = Query(50, ge=1, le=500), before_id: Optional[int] = None, current_user: User = Depends(get_current_active_user)):
+    conversation = db["conversations"].get(conversation_key(current_user.username, peer))
+    if conversation is None:
+        raise HTTPException(status_code=404, detail=f"No conversation with {peer}")
+    return [serialize_message(message_id) for message_id in page_message_ids(conversation["messages"], limit, before_id)]
+
+@app.post("/rooms")
+async def create_room(form: RoomForm, current_user: User = Depends(get_current_active_user)):
+    unknown = [username for username in form.members if username not in db["users"]]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Users not found: {unknown}")
+    room_id = next(reversed(db["rooms"]), 0) + 1
+    room = {"id": room_id, "name": form.name, "owner": current_user.username, "members": {}, "own_above_cursor": {}, "messages": []}
+    db["rooms"][room_id] = room
+    for username in [current_user.username, *form.members]:
+        add_room_member(room, username)
+    return {"message": "Successfully created room", "id": room_id}
+
+@app.get("/rooms")
+async def get_user_rooms(current_user: User = Depends(get_current_active_user)):
+    username = current_user.username
+    result = []
+    for room_id in sorted(db["user_rooms"].get(username, ())):
+        room = db["rooms"][room_id]
+        result.append({
+            "id": room_id,
+            "name": room["name"],
+            "owner": room["owner"],
+            "members": len(room["members"]),
+            "unread": room_unread_count(room, username),
+        })
+    return result
+
+@app.post("/rooms/{room_id}/members")
+async def add_member_to_room(room_id: int, form: RoomMemberForm, current_user: User = Depends(get_current_active_user)):
+    room = get_room_for_member(room_id, current_user.username)
+    if room["owner"] != current_user.username:
+        raise HTTPException(status_code=403, detail="Only the room owner can add members")
+    if form.username not in db["users"]:
+        raise HTTPException(status_code=404, detail=f"User {form.username} not found")
+    add_room_member(room, form.username)
+    return {"message": "Successfully added member"}
+
+@app.delete("/rooms/{room_id}/members/{username}")
+async def remove_member_from_room(room_id: int, username: str, current_user: User = Depends(get_current_active_user)):
+    room = get_room_for_member(room_id, current_user.username)
+    if current_user.username not in (room["owner"], username):
+        raise HTTPException(status_code=403, detail="Only the room owner can remove other members")
+    if username == room["owner"]:
+        raise HTTPException(status_code=400, detail="The room owner can't leave the room")
+    if username not in room["members"]:
+        raise HTTPException(status_code=404, detail=f"User {username} is not a member")
+    del room["members"][username]
+    del room["own_above_cursor"][username]
+    db["user_rooms"][username].discard(room_id)
+    return {"message": "Successfully removed member"}
+
+@app.post("/rooms/{room_id}/messages")
+async def send_room_message(room_id: int, form: RoomMessageForm, current_user: User = Depends(get_current_active_user)):
+    username = current_user.username
+    room = get_room_for_member(room_id, username)
+    caught_up = room_unread_count(room, username) == 0
+    message_id = db["room_messages"].add(username, f"#room-{room_id}", form.text, datetime.utcnow())
+    room["messages"].append(message_id)
+    # Moving the cursor past the sender's own post would also mark earlier unread messages read,
+    # so that only happens when they were caught up, otherwise the post is remembered as read above the cursor
+    if caught_up:
+        room["members"][username] = message_id
+        room["own_above_cursor"][username].clear()
+    else:
+        room["own_above_cursor"][username].append(message_id)
+    payload = {"type": "room_message", "message": jsonable_encoder(serialize_room_message(room_id, message_id))}
+    for member in room["members"]:
+        if member != username:
+            registry.push(member, payload)
+    return {"message": "Successfully sent message", "id": message_id}
+
+@app.get("/rooms/{room_id}/messages")
+async def get_room_messages(room_id: int, limit: int = Query(50, ge=1, le=500), before_id: Optional[int] = None, current_user: User = Depends(get_current_active_user)):
+    room = get_room_for_member(room_id, current_user.username)
+    return [serialize_room_message(room_id, message_id) for message_id in page_message_ids(room["messages"], limit, before_id)]
+
+@app.put("/rooms/{room_id}/read")
+async def read_room_messages(room_id: int, form: RoomReadForm, current_user: User = Depends(get_current_active_user)):
+    username = current_user.username
+    room = get_room_for_member(room_id, username)
+    latest = room["messages"][-1] if room["messages"] else 0
+    target = latest if form.up_to_id is None else min(form.up_to_id, latest)
+    room["members"][username] = max(room["members"][username], target)
+    own_above_cursor = room["own_above_cursor"][username]
+    del own_above_cursor[:bisect.bisect_right(own_above_cursor, room["members"][username])]
+    return {"message": "Successfully marked as read", "cursor": room["members"][username], "unread": room_unread_count(room, username)}
+
+@app.websocket("/messages/ws")
+async def messages_websocket(websocket: WebSocket, token: str = Query(...)):
+    try:
+        user = get_current_active_user(get_current_user(token))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    connection = Connection(websocket, user.username)
+    registry.register(connection)
+    sender = asyncio.create_task(connection.send_forever())
+    try:
+        while True:
+            try:
+                data = await websocket.receive_json()
+            except ValueError:
+                registry.send(connection, {"type": "error", "detail": "Invalid JSON"})
+                continue
+            if not isinstance(data, dict) or data.get("type") != "read" or not isinstance(data.get("id"), int):
+                registry.send(connection, {"type": "error", "detail": "Expected {\"type\": \"read\", \"id\": <message id>}"})
+                continue
+            try:
+                mark_message_read(data["id"], user.username)
+            except HTTPException as exc:
+                registry.send(connection, {"type": "error", "id": data["id"], "detail": exc.detail})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        registry.unregister(connection)
+        sender.cancel()
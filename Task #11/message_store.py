@@ -0,0 +1,87 @@
+# === Message Store File ===
+from array import array
+from datetime import datetime, timedelta
+from typing import Optional
+import sys
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+class MessageStore:
+    # Messages live in parallel arrays indexed by id - 1, so add() always hands out next_id()
+    def __init__(self):
+        self.user_ids: dict[str, int] = {}
+        self.usernames: list[str] = []
+        self.senders = array("I")
+        self.receivers = array("I")
+        self.timestamps = array("q")
+        self.text_offsets = array("Q", [0])
+        self.text = bytearray()
+        self.read_flags = bytearray()
+        self.deleted_flags = bytearray()
+
+    def __len__(self):
+        return len(self.senders)
+
+    def __contains__(self, message_id: int) -> bool:
+        return 0 < message_id <= len(self) and not self._get_bit(self.deleted_flags, message_id - 1)
+
+    def __getitem__(self, message_id: int) -> dict:
+        if message_id not in self:
+            raise KeyError(message_id)
+        index = message_id - 1
+        return {
+            "receiver": self.usernames[self.receivers[index]],
+            "text": self.text[self.text_offsets[index]:self.text_offsets[index + 1]].decode(),
+            "id": message_id,
+            "sender": self.usernames[self.senders[index]],
+            "is_read": self._get_bit(self.read_flags, index),
+            "timestamp": EPOCH + self.timestamps[index] * MICROSECOND,
+        }
+
+    def __delitem__(self, message_id: int):
+        # The text stays in the append-only buffer, only the id stops resolving
+        if message_id not in self:
+            raise KeyError(message_id)
+        self._set_bit(self.deleted_flags, message_id - 1)
+
+    def next_id(self) -> int:
+        return len(self) + 1
+
+    def get(self, message_id: int) -> Optional[dict]:
+        return self[message_id] if message_id in self else None
+
+    def intern_user(self, username: str) -> int:
+        if username not in self.user_ids:
+            self.user_ids[username] = len(self.usernames)
+            self.usernames.append(sys.intern(username))
+        return self.user_ids[username]
+
+    def add(self, sender: str, receiver: str, text: str, timestamp: datetime) -> int:
+        self.senders.append(self.intern_user(sender))
+        self.receivers.append(self.intern_user(receiver))
+        self.timestamps.append((timestamp - EPOCH) // MICROSECOND)
+        self.text += text.encode()
+        self.text_offsets.append(len(self.text))
+        if len(self) > len(self.read_flags) * 8:
+            self.read_flags.append(0)
+            self.deleted_flags.append(0)
+        return len(self)
+
+    def sender(self, message_id: int) -> str:
+        return self.usernames[self.senders[message_id - 1]]
+
+    def receiver(self, message_id: int) -> str:
+        return self.usernames[self.receivers[message_id - 1]]
+
+    def is_read(self, message_id: int) -> bool:
+        return self._get_bit(self.read_flags, message_id - 1)
+
+    def mark_read(self, message_id: int):
+        self._set_bit(self.read_flags, message_id - 1)
+
+    def _get_bit(self, flags: bytearray, index: int) -> bool:
+        return bool(flags[index >> 3] & (1 << (index & 7)))
+
+    def _set_bit(self, flags: bytearray, index: int):
+        flags[index >> 3] |= 1 << (index & 7)
@@ -1,6 +1,7 @@
 # === Models File ===
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional
+from datetime import datetime
 
 class Token(BaseModel):
     access_token : str
@@ -30,6 +31,26 @@ class Message(MessageForm):
     id : int
     sender : str
     is_read : Optional[bool] = False
+    timestamp : datetime = Field(default_factory=datetime.utcnow)
+
+class ReadMarkForm(BaseModel):
+    ids : Optional[list[int]] = None
+    peer : Optional[str] = None
+    up_to_id : Optional[int] = None
+    all : bool = False
+
+class RoomForm(BaseModel):
+    name : str
+    members : list[str] = Field(default_factory=list)
+
+class RoomMemberForm(BaseModel):
+    username : str
+
+class RoomMessageForm(BaseModel):
+    text : str
+
+class RoomReadForm(BaseModel):
+    up_to_id : Optional[int] = None
 
         
     
@@ -0,0 +1,68 @@
+# === Broadcast File ===
+import asyncio
+import json
+from fastapi.encoders import jsonable_encoder
+
+SUBSCRIBER_BUFFER_SIZE = 256
+HEARTBEAT_INTERVAL = 15
+HEARTBEAT_FRAME = b": heartbeat\n\n"
+RETRY_FRAME = b"retry: 1000\n\n"
+
+
+def encode_event(notification: dict) -> bytes:
+    data = json.dumps(jsonable_encoder(notification), ensure_ascii=False)
+    return f"id: {notification['id']}\nevent: {notification['type']}\ndata: {data}\n\n".encode()
+
+
+class Subscriber:
+    def __init__(self, username: str):
+        self.username = username
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_BUFFER_SIZE)
+        self.overflowed = False
+
+    def offer(self, event_id: int, frame: bytes) -> bool:
+        try:
+            self.queue.put_nowait((event_id, frame))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+
+class BroadcastHub:
+    def __init__(self):
+        self.subscribers: dict[str, set[Subscriber]] = {}
+
+    def subscribe(self, username: str) -> Subscriber:
+        subscriber = Subscriber(username)
+        self.subscribers.setdefault(username, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        sessions = self.subscribers.get(subscriber.username)
+        if sessions is None:
+            return
+        sessions.discard(subscriber)
+        if not sessions:
+            del self.subscribers[subscriber.username]
+
+    def publish_global(self, notification: dict):
+        # Encoded once, every subscriber queues a reference to the same bytes
+        frame = encode_event(notification)
+        for sessions in list(self.subscribers.values()):
+            for subscriber in list(sessions):
+                if not subscriber.offer(notification["id"], frame):
+                    self.drop_slow_subscriber(subscriber)
+
+    def publish_personal(self, username: str, notification: dict):
+        sessions = self.subscribers.get(username)
+        if not sessions:
+            return
+        frame = encode_event(notification)
+        for subscriber in list(sessions):
+            if not subscriber.offer(notification["id"], frame):
+                self.drop_slow_subscriber(subscriber)
+
+    def drop_slow_subscriber(self, subscriber: Subscriber):
+        # The stream ends once its buffer drains, the client reconnects with Last-Event-ID and replays the gap
+        subscriber.overflowed = True
+        self.unsubscribe(subscriber)
@@ -1,5 +1,6 @@
 # === Main File ===
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, Query, Header, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from typing import Optional
@@ -7,37 +8,172 @@ from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
 import asyncio
+from contextlib import asynccontextmanager
+import bisect
+import heapq
+import itertools
 import os
 
 from models import *
+from scheduler import Scheduler
+from broadcast import BroadcastHub, HEARTBEAT_FRAME, HEARTBEAT_INTERVAL, RETRY_FRAME, encode_event
 
 db = {
     "users": {},
-    "global_notifications": {}
+    "global_notifications": [],
+    "global_evicted": 0,
+    "personal_notification_ids": {},
+    "personal_unread": {},
+    "global_read": {},
 }
 
+# Personal and global notifications share one increasing id sequence, so a user's feed merges by id
+notification_ids = itertools.count()
+
 load_dotenv()
 
+GLOBAL_NOTIFICATION_MAX_COUNT = int(os.getenv("GLOBAL_NOTIFICATION_MAX_COUNT", 1000))
+GLOBAL_NOTIFICATION_MAX_AGE = timedelta(seconds=int(os.getenv("GLOBAL_NOTIFICATION_MAX_AGE_SECONDS", 7 * 24 * 3600)))
+GLOBAL_NOTIFICATION_COMPACT_INTERVAL = int(os.getenv("GLOBAL_NOTIFICATION_COMPACT_INTERVAL_SECONDS", 60))
+CHECK_IN_INTERVAL = int(os.getenv("CHECK_IN_INTERVAL_SECONDS", 60))
+SCHEDULER_DRAIN_TIMEOUT = int(os.getenv("SCHEDULER_DRAIN_TIMEOUT_SECONDS", 10))
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-app = FastAPI()
+scheduler = Scheduler()
+hub = BroadcastHub()
+# Jobs created through the admin API, the built-in jobs are not exposed for cancelling
+scheduled_notification_jobs = set()
+builtin_job_ids = []
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Jobs outlive a lifespan like the rest of the in-memory state, so the built-in ones are only registered once
+    if not builtin_job_ids:
+        builtin_job_ids.append(
+            scheduler.add_job("compact_global_notifications", compact_global_notifications, interval=GLOBAL_NOTIFICATION_COMPACT_INTERVAL).id
+        )
+        builtin_job_ids.append(
+            scheduler.add_job(
+                "check_in_notification",
+                make_scheduled_notification("🛎️ Scheduled check-in: Remember to update your status!"),
+                interval=CHECK_IN_INTERVAL,
+            ).id
+        )
+    scheduler.start()
+    yield
+    await scheduler.stop(timeout=SCHEDULER_DRAIN_TIMEOUT)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 # ================== Helper Functions ===================
 
-async def create_scheduled_notification():
-    while True:
-        notificationID = 0
-        while notificationID in db["global_notifications"]:
-            notificationID += 1
-        db["global_notifications"][notificationID] = GlobalNotification(
-            text="🛎️ Scheduled check-in: Remember to update your status!",
-            type="global",
-            id=notificationID,
-        ).dict()
-        print("✅ Scheduled global notification created")
-        await asyncio.sleep(60)
+def add_global_notification(text: str) -> dict:
+    # Entries are validated and serialized once here, readers share the stored dicts
+    notification = GlobalNotification(
+        text=text,
+        type="global",
+        id=next(notification_ids),
+        created_at=datetime.utcnow(),
+    ).dict()
+    db["global_notifications"].append(notification)
+    if len(db["global_notifications"]) > GLOBAL_NOTIFICATION_MAX_COUNT:
+        compact_global_notifications()
+    hub.publish_global(notification)
+    return notification
+
+
+def compact_global_notifications(now: Optional[datetime] = None) -> int:
+    # Drops expired and over-limit entries from the front, ids and read watermarks are positions that never shift
+    notifications = db["global_notifications"]
+    cutoff = (now or datetime.utcnow()) - GLOBAL_NOTIFICATION_MAX_AGE
+    dropped = max(len(notifications) - GLOBAL_NOTIFICATION_MAX_COUNT, 0)
+    while dropped < len(notifications) and notifications[dropped]["created_at"] < cutoff:
+        dropped += 1
+    if dropped:
+        del notifications[:dropped]
+        db["global_evicted"] += dropped
+    return dropped
+
+
+def make_scheduled_notification(text: str):
+    async def send_scheduled_notification():
+        add_global_notification(text)
+    return send_scheduled_notification
+
+
+def global_read_position(username: str) -> int:
+    # global_read counts global notifications the user has read since the sequence began, evicted ones included
+    return max(db["global_read"].get(username, 0), db["global_evicted"])
+
+
+def global_unread_count(username: str) -> int:
+    return db["global_evicted"] + len(db["global_notifications"]) - global_read_position(username)
+
+
+def iter_personal_notifications(username: str, after: Optional[int], unread_only: bool):
+    ids = db["personal_notification_ids"].get(username, [])
+    notifications = db["users"][username]["personal_notifications"]
+    start = 0 if after is None else bisect.bisect_right(ids, after)
+    for notification_id in ids[start:]:
+        notification = notifications[notification_id]
+        if not unread_only or not notification["is_read"]:
+            yield notification
+
+
+def global_notification_position(after: Optional[int]) -> int:
+    notifications = db["global_notifications"]
+    return 0 if after is None else bisect.bisect_right(notifications, after, key=lambda notification: notification["id"])
+
+
+def iter_global_notifications(username: str, after: Optional[int], unread_only: bool):
+    notifications = db["global_notifications"]
+    read = global_read_position(username) - db["global_evicted"]
+    start = global_notification_position(after)
+    if unread_only:
+        start = max(start, read)
+    for position in range(start, len(notifications)):
+        if unread_only:
+            yield notifications[position]
+        else:
+            yield dict(notifications[position], is_read=position < read)
+
+
+async def stream_notifications(request: Request, subscriber, last_event_id: Optional[int]):
+    username = subscriber.username
+    sent = last_event_id
+    try:
+        yield RETRY_FRAME
+        if last_event_id is not None:
+            # Subscribed before replaying, so anything published meanwhile is queued and deduplicated by id.
+            # Globals are replayed as stored, without per-user read state, to match the shared live frames
+            notifications = db["global_notifications"]
+            backlog = heapq.merge(
+                iter_personal_notifications(username, last_event_id, False),
+                (notifications[position] for position in range(global_notification_position(last_event_id), len(notifications))),
+                key=lambda notification: notification["id"],
+            )
+            for notification in backlog:
+                sent = notification["id"]
+                yield encode_event(notification)
+        while not (subscriber.overflowed and subscriber.queue.empty()):
+            try:
+                event_id, frame = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield HEARTBEAT_FRAME
+                continue
+            if sent is not None and event_id <= sent:
+                continue
+            sent = event_id
+            yield frame
+    finally:
+        hub.unsubscribe(subscriber)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -93,12 +229,13 @@ def get_current_active_user(current_user: UserInDB = Depends(get_current_user))
     return current_user
 
 
-# ================== Routes ===================
+def get_current_admin(current_user: UserInDB = Depends(get_current_active_user)) -> UserInDB:
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can manage scheduled notifications")
+    return current_user
 
-@app.on_event("startup")
-async def start_notifications_loop():
-    asyncio.create_task(create_scheduled_notification())
 
+# ================== Routes ===================
 
 @app.get("/")
 def base_url():
@@ -134,6 +271,9 @@ async def register_new_user(form: UserRegister):
         disabled=False,
         personal_notifications={}
     ).dict()
+    db["personal_notification_ids"][username] = []
+    db["personal_unread"][username] = 0
+    db["global_read"][username] = 0
     return {"message": "Successfully registered"}
 
 
@@ -149,14 +289,7 @@ async def create_global_notification(
 ):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Only admins can send global notifications")
-    notificationID = 0
-    while notificationID in db["global_notifications"]:
-        notificationID += 1
-    db["global_notifications"][notificationID] = GlobalNotification(
-        text=form.text,
-        type="global",
-        id=notificationID,
-    ).dict()
+    add_global_notification(form.text)
     return {"message": "Successfully created global notification"}
 
 
@@ -166,53 +299,110 @@ async def send_personal_notification(
     form: NotificationForm,
     current_user: UserInDB = Depends(get_current_active_user)
 ):
-    user = get_user(db, username)
-    if user is None:
+    if username not in db["users"]:
         raise HTTPException(status_code=404, detail=f"User {username} not found")
-    notificationID = 0
-    while notificationID in user.personal_notifications:
-        notificationID += 1
-    user.personal_notifications[notificationID] = UserNotification(
+    notificationID = next(notification_ids)
+    db["users"][username]["personal_notifications"][notificationID] = UserNotification(
         text=form.text,
         type="personal",
         id=notificationID,
         is_read=False
     ).dict()
-    db["users"][user.username]["personal_notifications"] = user.personal_notifications
+    db["personal_notification_ids"].setdefault(username, []).append(notificationID)
+    db["personal_unread"][username] = db["personal_unread"].get(username, 0) + 1
+    hub.publish_personal(username, db["users"][username]["personal_notifications"][notificationID])
     return {"message": "Successfully created personal notification"}
 
 
 @app.get("/notifications")
-async def get_all_user_notifications(current_user: UserInDB = Depends(get_current_active_user)):
-    notifications = []
+async def get_all_user_notifications(
+    unread_only: bool = Query(True),
+    limit: int = Query(50, ge=1, le=500),
+    after: Optional[int] = Query(None),
+    current_user: UserInDB = Depends(get_current_active_user)
+):
+    username = current_user.username
+    feed = heapq.merge(
+        iter_personal_notifications(username, after, unread_only),
+        iter_global_notifications(username, after, unread_only),
+        key=lambda notification: notification["id"],
+    )
+    notifications = list(itertools.islice(feed, limit))
+    return {
+        "unread": {
+            "personal": db["personal_unread"].get(username, 0),
+            "global": global_unread_count(username),
+        },
+        "notifications": notifications,
+        "next_after": notifications[-1]["id"] if len(notifications) == limit else None,
+    }
+
+
+@app.get("/notifications/stream")
+async def get_notifications_stream(
+    request: Request,
+    last_event_id: Optional[int] = Header(None, alias="Last-Event-ID"),
+    current_user: UserInDB = Depends(get_current_active_user)
+):
+    subscriber = hub.subscribe(current_user.username)
+    return StreamingResponse(
+        stream_notifications(request, subscriber, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    for notif in current_user.personal_notifications.values():
-        if isinstance(notif, dict):
-            notif = UserNotification(**notif)
-        if not notif.is_read:
-            notifications.append(notif.dict())
 
-    for notif in db["global_notifications"].values():
-        if isinstance(notif, dict):
-            notif = GlobalNotification(**notif)
-        notifications.append(notif.dict())
+@app.put("/notifications/global/read")
+async def mark_global_notifications_as_read(up_to_id: Optional[int] = Query(None), current_user: UserInDB = Depends(get_current_active_user)):
+    notifications = db["global_notifications"]
+    read = len(notifications)
+    if up_to_id is not None:
+        read = bisect.bisect_right(notifications, up_to_id, key=lambda notification: notification["id"])
+    read += db["global_evicted"]
+    db["global_read"][current_user.username] = max(db["global_read"].get(current_user.username, 0), read)
+    return {"message": "Marked as read", "unread": global_unread_count(current_user.username)}
 
-    return notifications
 
 @app.put("/notifications/{id}/read")
 async def mark_notification_as_read(id: int, current_user: UserInDB = Depends(get_current_active_user)):
-    if id not in current_user.personal_notifications:
+    username = current_user.username
+    notifications = db["users"][username]["personal_notifications"]
+    if id not in notifications:
         raise HTTPException(status_code=404, detail=f"Notification ID {id} not found")
-    
-    notif_data = current_user.personal_notifications[id]
-    if isinstance(notif_data, dict):
-        notif = UserNotification(**notif_data)
-    else:
-        notif = notif_data
-    
-    notif.is_read = True
-    
-    current_user.personal_notifications[id] = notif.dict()
-    db["users"][current_user.username]["personal_notifications"] = current_user.personal_notifications
-    
+
+    if not notifications[id]["is_read"]:
+        notifications[id]["is_read"] = True
+        db["personal_unread"][username] -= 1
+
     return {"message": "Marked as read"}
+
+
+@app.post("/admin/scheduled-notifications")
+async def create_scheduled_notification(form: ScheduledNotificationForm, current_user: UserInDB = Depends(get_current_admin)):
+    try:
+        job = scheduler.add_job(
+            f"scheduled_notification:{form.text[:32]}",
+            make_scheduled_notification(form.text),
+            interval=form.interval_seconds,
+            cron=form.cron,
+            jitter=form.jitter_seconds,
+            max_retries=form.max_retries,
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    scheduled_notification_jobs.add(job.id)
+    return {"message": "Successfully scheduled notification", "job": job.snapshot()}
+
+
+@app.get("/admin/scheduled-notifications")
+async def get_scheduled_jobs(current_user: UserInDB = Depends(get_current_admin)):
+    return [job.snapshot() for job in scheduler.jobs.values()]
+
+
+@app.delete("/admin/scheduled-notifications/{job_id}")
+async def cancel_scheduled_notification(job_id: int, current_user: UserInDB = Depends(get_current_admin)):
+    if job_id not in scheduled_notification_jobs:
+        raise HTTPException(status_code=404, detail=f"Scheduled notification {job_id} not found")
+    scheduled_notification_jobs.discard(job_id)
+    scheduler.cancel(job_id)
+    return {"message": "Successfully cancelled scheduled notification"}
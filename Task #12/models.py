@@ -1,6 +1,7 @@
 # === Models File ===
 from pydantic import BaseModel, Field
 from typing import Optional
+from datetime import datetime
 
 class Token(BaseModel):
     access_token : str
@@ -20,6 +21,14 @@ class UserNotification(NotificationForm):
 class GlobalNotification(NotificationForm):
     id : int = None
     type : Optional[str] = "global"
+    created_at : Optional[datetime] = None
+
+class ScheduledNotificationForm(BaseModel):
+    text : str
+    interval_seconds : Optional[float] = Field(None, gt=0)
+    cron : Optional[str] = None
+    jitter_seconds : float = Field(0, ge=0)
+    max_retries : int = Field(0, ge=0, le=10)
 
 class UserRegister(BaseModel):
     username : str = None
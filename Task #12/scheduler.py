@@ -0,0 +1,299 @@
+# === Scheduler File ===
+import asyncio
+import heapq
+import inspect
+import itertools
+import logging
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+CRON_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 7),
+)
+# Long enough for a Feb 29 schedule to match across a skipped leap year
+CRON_SEARCH_YEARS = 10
+RUNNER_RESTART_DELAY = 1
+
+
+class CronSchedule:
+    """Five field cron expression: minute hour day month weekday (0 or 7 = Sunday, as in cron).
+    Fields accept *, numbers, ranges a-b, steps */n or a-b/n and comma separated lists."""
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != len(CRON_FIELDS):
+            raise ValueError("Cron expression must have 5 fields")
+        self.expression = expression
+        self.values = [
+            self.parse_field(part, low, high, name)
+            for part, (name, low, high) in zip(parts, CRON_FIELDS)
+        ]
+        self.minutes, self.hours, self.days, self.months, weekdays = self.values
+        self.weekdays = frozenset(weekday % 7 for weekday in weekdays)
+        # Like classic cron, a restricted day and weekday match if either one does
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def parse_field(part: str, low: int, high: int, name: str) -> frozenset:
+        values = set()
+        for item in part.split(","):
+            value_range, _, step = item.partition("/")
+            if value_range == "*":
+                start, end = low, high
+            elif "-" in value_range:
+                start, end = (int(value) for value in value_range.split("-", 1))
+            else:
+                start = end = int(value_range)
+                if step:
+                    end = high
+            step = int(step) if step else 1
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Invalid cron {name} field: {item}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def matches_day(self, moment: datetime) -> bool:
+        day_match = moment.day in self.days
+        # datetime counts weekdays from Monday = 0, cron from Sunday = 0
+        weekday_match = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    def next_after(self, moment: datetime) -> datetime:
+        # Skips whole months, days and hours that can't match instead of stepping minute by minute
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        horizon = candidate.replace(year=candidate.year + CRON_SEARCH_YEARS, day=1)
+        while candidate < horizon:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression never matches: {self.expression}")
+
+
+class Job:
+    def __init__(
+        self,
+        id: int,
+        name: str,
+        func: Callable[[], Optional[Awaitable[None]]],
+        interval: Optional[float] = None,
+        cron: Optional[CronSchedule] = None,
+        jitter: float = 0,
+        max_concurrency: int = 1,
+        max_retries: int = 0,
+        retry_backoff: float = 1.0,
+    ):
+        self.id = id
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.cron = cron
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.cancelled = False
+        self.running = 0
+        # Slot the job was due in, jitter is applied on top so it never accumulates into the schedule
+        self.due_at: Optional[float] = None
+        self.metrics = {
+            "runs": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "skipped_overlap": 0,
+            "missed_slots": 0,
+            "last_started_at": None,
+            "last_duration": None,
+            "total_duration": 0.0,
+            "max_lag": 0.0,
+            "last_error": None,
+        }
+
+    def next_due(self, now: float) -> float:
+        if self.cron is not None:
+            wall_now = datetime.now()
+            return now + (self.cron.next_after(wall_now) - wall_now).total_seconds()
+        if self.due_at is None:
+            return now + self.interval
+        # Drift correction: step from the previous slot, not from when the run finished, and skip slots already missed
+        next_due = self.due_at + self.interval
+        if next_due <= now:
+            missed = math.ceil((now - next_due) / self.interval)
+            self.metrics["missed_slots"] += missed
+            next_due += missed * self.interval
+        return next_due
+
+    def snapshot(self) -> dict:
+        runs = self.metrics["runs"]
+        return {
+            "id": self.id,
+            "name": self.name,
+            "interval_seconds": self.interval,
+            "cron": self.cron.expression if self.cron else None,
+            "jitter_seconds": self.jitter,
+            "max_concurrency": self.max_concurrency,
+            "max_retries": self.max_retries,
+            "running": self.running,
+            "next_run_in": None if self.due_at is None else max(self.due_at - time.monotonic(), 0),
+            **self.metrics,
+            "average_duration": self.metrics["total_duration"] / runs if runs else None,
+        }
+
+
+class Scheduler:
+    """Single task timer loop over a heap of (fire_at, sequence, job), jobs run as their own tasks."""
+
+    def __init__(self):
+        self.jobs: dict[int, Job] = {}
+        self.queue: list[tuple[float, int, Job]] = []
+        self.job_ids = itertools.count(1)
+        self.sequence = itertools.count()
+        # Created in start(), an Event is bound to the loop it is first awaited on
+        self.wakeup: Optional[asyncio.Event] = None
+        self.runner: Optional[asyncio.Task] = None
+        self.in_flight: set[asyncio.Task] = set()
+        self.stopped = False
+
+    def add_job(self, name: str, func: Callable[[], Optional[Awaitable[None]]], interval: Optional[float] = None, cron: Optional[str] = None, **options) -> Job:
+        if (interval is None) == (cron is None):
+            raise ValueError("Exactly one of interval or cron is required")
+        if interval is not None and interval <= 0:
+            raise ValueError("Interval must be positive")
+        if options.get("max_concurrency", 1) < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        cron_schedule = None
+        if cron is not None:
+            cron_schedule = CronSchedule(cron)
+            # Raises for expressions that never match, before any id or state is taken
+            cron_schedule.next_after(datetime.now())
+        job = Job(next(self.job_ids), name, func, interval=interval, cron=cron_schedule, **options)
+        self.schedule(job, time.monotonic())
+        self.jobs[job.id] = job
+        return job
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return False
+        # The heap entry is dropped lazily when it comes due
+        job.cancelled = True
+        return True
+
+    def schedule(self, job: Job, now: float):
+        job.due_at = job.next_due(now)
+        fire_at = job.due_at + (random.uniform(0, job.jitter) if job.jitter else 0)
+        heapq.heappush(self.queue, (fire_at, next(self.sequence), job))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def start(self):
+        if self.runner is None:
+            self.wakeup = asyncio.Event()
+            self.stopped = False
+            # A crashed runner may have popped a job without rescheduling it, put any such job back on the heap
+            queued = {job.id for _, _, job in self.queue}
+            now = time.monotonic()
+            for job in self.jobs.values():
+                if job.id not in queued:
+                    self.schedule(job, now)
+            self.runner = asyncio.create_task(self.run_forever())
+            self.runner.add_done_callback(self.on_runner_done)
+
+    def on_runner_done(self, runner: asyncio.Task):
+        # stop() cancels the runner, any other exit is a crash that would otherwise leave every job silently unscheduled
+        if runner.cancelled() or runner is not self.runner:
+            return
+        logger.error("Scheduler runner stopped unexpectedly, restarting in %ss", RUNNER_RESTART_DELAY, exc_info=runner.exception())
+        self.runner = None
+        asyncio.get_running_loop().call_later(RUNNER_RESTART_DELAY, self.restart_runner)
+
+    def restart_runner(self):
+        if self.runner is None and not self.stopped:
+            self.start()
+
+    async def stop(self, timeout: float = 10):
+        # Stops firing new runs, then gives running jobs a grace period before cancelling them
+        self.stopped = True
+        if self.runner is not None:
+            runner, self.runner = self.runner, None
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+        if self.in_flight:
+            _, pending = await asyncio.wait(self.in_flight, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def run_forever(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                fire_at, _, job = heapq.heappop(self.queue)
+                if job.cancelled:
+                    continue
+                self.fire(job, fire_at, now)
+            delay = self.queue[0][0] - now if self.queue else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def fire(self, job: Job, fire_at: float, now: float):
+        job.metrics["max_lag"] = max(job.metrics["max_lag"], now - fire_at)
+        if job.running >= job.max_concurrency:
+            job.metrics["skipped_overlap"] += 1
+        else:
+            job.running += 1
+            task = asyncio.create_task(self.execute(job))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+        self.schedule(job, now)
+
+    async def execute(self, job: Job):
+        started = time.monotonic()
+        job.metrics["runs"] += 1
+        job.metrics["last_started_at"] = datetime.utcnow()
+        try:
+            for attempt in range(job.max_retries + 1):
+                try:
+                    result = job.func()
+                    if inspect.isawaitable(result):
+                        await result
+                except asyncio.CancelledError:
+                    raise
+                except Exception as error:
+                    job.metrics["last_error"] = repr(error)
+                    logger.exception("Scheduled job %s (%s) failed on attempt %d", job.id, job.name, attempt + 1)
+                    if attempt == job.max_retries or job.cancelled:
+                        job.metrics["failures"] += 1
+                        return
+                    job.metrics["retries"] += 1
+                    await asyncio.sleep(job.retry_backoff * 2 ** attempt)
+                else:
+                    job.metrics["successes"] += 1
+                    return
+        finally:
+            job.running -= 1
+            duration = time.monotonic() - started
+            job.metrics["last_duration"] = duration
+            job.metrics["total_duration"] += duration
@@ -1,10 +1,125 @@
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, HTTPException
 from typing import Optional, List
 from pydantic import BaseModel
+import random
+import threading
 
 app = FastAPI()
 
+class OrderNode:
+    __slots__ = ("todo_id", "priority", "size", "left", "right", "parent")
+
+    def __init__(self, todo_id: int):
+        self.todo_id = todo_id
+        self.priority = random.random()
+        self.size = 1
+        self.left = None
+        self.right = None
+        self.parent = None
+
+class OrderTree:
+    # Implicit treap: nodes are keyed by position through subtree sizes, so insert,
+    # remove, k-th lookup and rank are all O(log n) expected
+    def __init__(self):
+        self.root = None
+        self.nodes = {}
+
+    def __len__(self):
+        return self.root.size if self.root else 0
+
+    def _update(self, node):
+        node.size = 1
+        if node.left:
+            node.size += node.left.size
+            node.left.parent = node
+        if node.right:
+            node.size += node.right.size
+            node.right.parent = node
+
+    def _split(self, node, count):
+        # Returns (first `count` nodes, the rest)
+        if node is None:
+            return None, None
+        left_size = node.left.size if node.left else 0
+        if count <= left_size:
+            left, node.left = self._split(node.left, count)
+            self._update(node)
+            return left, node
+        node.right, right = self._split(node.right, count - left_size - 1)
+        self._update(node)
+        return node, right
+
+    def _merge(self, left, right):
+        if left is None or right is None:
+            return left or right
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            self._update(left)
+            return left
+        right.left = self._merge(left, right.left)
+        self._update(right)
+        return right
+
+    def _set_root(self, node):
+        self.root = node
+        if node:
+            node.parent = None
+
+    def insert(self, todo_id: int, position: int):
+        node = OrderNode(todo_id)
+        self.nodes[todo_id] = node
+        left, right = self._split(self.root, position)
+        self._set_root(self._merge(self._merge(left, node), right))
+
+    def remove(self, todo_id: int):
+        position = self.position(todo_id)
+        left, rest = self._split(self.root, position)
+        node, right = self._split(rest, 1)
+        node.parent = None
+        del self.nodes[todo_id]
+        self._set_root(self._merge(left, right))
+
+    def position(self, todo_id: int) -> int:
+        node = self.nodes[todo_id]
+        position = node.left.size if node.left else 0
+        while node.parent:
+            if node is node.parent.right:
+                position += 1 + (node.parent.left.size if node.parent.left else 0)
+            node = node.parent
+        return position
+
+    def move(self, todo_id: int, position: int):
+        self.remove(todo_id)
+        self.insert(todo_id, position)
+
+    def slice(self, offset: int, limit: int) -> List[int]:
+        result = []
+        stack = []
+        node = self.root
+        # Descend to the offset-th node, keeping the ancestors still to be visited in order
+        while node:
+            left_size = node.left.size if node.left else 0
+            if offset < left_size:
+                stack.append(node)
+                node = node.left
+            elif offset == left_size:
+                stack.append(node)
+                break
+            else:
+                offset -= left_size + 1
+                node = node.right
+        while stack and len(result) < limit:
+            node = stack.pop()
+            result.append(node.todo_id)
+            node = node.right
+            while node:
+                stack.append(node)
+                node = node.left
+        return result
+
 todos = []
+todo_order = OrderTree()
+todos_lock = threading.Lock()
 
 class Todo(BaseModel):
     title: str
@@ -15,13 +130,26 @@ class TodoWithID(Todo):
 
 @app.post("/todos")
 def post_todo(todo: Todo):
-    new_id = len(todos)
-    new_todo = TodoWithID(id=new_id, **todo.dict())
-    todos.append(new_todo)
+    with todos_lock:
+        new_id = len(todos)
+        new_todo = TodoWithID(id=new_id, **todo.dict())
+        todos.append(new_todo)
+        todo_order.insert(new_id, len(todo_order))
     return {"message": "Successfully added", "todo": new_todo}
 
 @app.get("/todos", response_model=List[TodoWithID])
-def get_todos(completed: Optional[bool] = Query(None)):
-    if completed is None:
-        return todos
-    return [todo for todo in todos if todo.completed == completed]
+def get_todos(completed: Optional[bool] = Query(None), offset: int = Query(0, ge=0), limit: Optional[int] = Query(None, ge=1)):
+    with todos_lock:
+        if completed is None:
+            return [todos[todo_id] for todo_id in todo_order.slice(offset, limit or len(todo_order))]
+        ordered = [todos[todo_id] for todo_id in todo_order.slice(0, len(todo_order))]
+    filtered = [todo for todo in ordered if todo.completed == completed]
+    return filtered[offset:offset + limit if limit else None]
+
+@app.post("/todos/{todo_id}/move", response_model=TodoWithID)
+def move_todo(todo_id: int, position: int = Query(..., ge=0)):
+    with todos_lock:
+        if todo_id not in todo_order.nodes:
+            raise HTTPException(status_code=404, detail=f"Todo with id {todo_id} not found")
+        todo_order.move(todo_id, min(position, len(todo_order) - 1))
+        return todos[todo_id]
@@ -1,9 +1,11 @@
 from fastapi import FastAPI, HTTPException, Depends
 from pydantic import BaseModel
 from typing import Optional
+from collections import defaultdict
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import jwt, JWTError
 from passlib.context import CryptContext
+import asyncio
 import jwtconfig
 
 users_db = {
@@ -31,9 +33,18 @@ class UserInDB(User):
 class MoneyForm(BaseModel):
     money : int = None
 
+class TransferForm(BaseModel):
+    receiver : str
+    money : int
+
+class BatchTransferForm(BaseModel):
+    transfers : list[TransferForm]
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+account_locks = defaultdict(asyncio.Lock)
+
 app = FastAPI()
 
 def verify_password(plain_password : str, hashed_password : str):
@@ -103,3 +114,35 @@ async def withdraw_money(moneyForm : MoneyForm, current_user : User = Depends(ge
     users_db[username]["balance"] -= moneyForm.money
     return {"message" : "succesfully withdrawn"}
 
+@app.post("/transfers/batch")
+async def batch_transfer_money(form : BatchTransferForm, current_user : User = Depends(get_current_user)):
+    if not form.transfers:
+        raise HTTPException(status_code=400, detail = "Not provided transfers")
+
+    sender = current_user.username
+    deltas = {sender : 0}
+    for transfer in form.transfers:
+        if transfer.money <= 0:
+            raise HTTPException(status_code=400, detail = "Transfer amount must be positive")
+        if transfer.receiver == sender:
+            raise HTTPException(status_code=400, detail = "Can't transfer money to yourself")
+        if transfer.receiver not in users_db:
+            raise HTTPException(status_code=404, detail=f"There is no user with username {transfer.receiver}")
+        deltas[sender] -= transfer.money
+        deltas[transfer.receiver] = deltas.get(transfer.receiver, 0) + transfer.money
+
+    # Accounts are always locked in username order so concurrent batches can't deadlock
+    accounts = sorted(deltas)
+    for username in accounts:
+        await account_locks[username].acquire()
+    try:
+        for username in accounts:
+            if users_db[username]["balance"] + deltas[username] < 0:
+                raise HTTPException(status_code=400, detail = f"Not enough funds on account {username}")
+        for username in accounts:
+            users_db[username]["balance"] += deltas[username]
+    finally:
+        for username in reversed(accounts):
+            account_locks[username].release()
+
+    return {"message" : "succesfully transferred", "transfers" : len(form.transfers), "balance" : users_db[sender]["balance"]}
@@ -1,10 +1,16 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Depends, Query
+from pydantic import BaseModel
 from typing import Optional
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
+from collections import Counter
+import bisect
+import difflib
+import heapq
+import math
+import re
 
 import jwtconfig
 
@@ -12,17 +18,20 @@ db = {
     "andrew" : {
         "username" : "andrew",
         "hashed_password" : "$2b$12$KnfWVQxuIsUJayLAjiOreeLOfv2PYDv51KkcoTmja3GZFuOQdE78G",
-        "notes" : {
-            0 : {
-                "id" : 0,
-                "title" : "My First Note",
-                "content" : "That is my first note",
-            }
-        },
         "disabled" : False,
     }
 }
 
+notes_db = {
+    "andrew" : {
+        0 : {
+            "id" : 0,
+            "title" : "My First Note",
+            "content" : "That is my first note",
+        }
+    }
+}
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -37,10 +46,18 @@ class NoteCreate(BaseModel):
 class Note(NoteCreate):
     id: int
 
+class NoteUpdate(BaseModel):
+    title: Optional[str] = None
+    content: Optional[str] = None
+
+class NoteRevision(BaseModel):
+    rev: int
+    updated_at: datetime
+    checkpoint: bool
+
 class User(BaseModel):
     username: str
     disabled: Optional[bool] = False
-    notes: dict[int, Note] = Field(default_factory=dict)
 
 class UserInDB(User):
     hashed_password: str
@@ -49,6 +66,31 @@ class RegisterUser(BaseModel):
     username : str
     password : str
 
+class NoteSearchResult(Note):
+    score: float
+    snippet: str
+
+class NotesPage(BaseModel):
+    notes: list[dict]
+    next_cursor: Optional[int] = None
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+SNIPPET_LENGTH = 80
+TOKEN_PATTERN = re.compile(r"\w+")
+
+NOTE_FIELDS = ("id", "title", "content")
+REVISION_CHECKPOINT_INTERVAL = 16
+DELTA_LINE_PATTERN = re.compile(r"[^\n]*\n|[^\n]+")
+DELTA_SENTENCE_PATTERN = re.compile(r"[^.!?]+[.!?]*\s*|[.!?]+\s*")
+DELTA_WORD_PATTERN = re.compile(r"\w+|\s+|[^\w\s]+")
+
+notes_index = {}
+note_ids = {username : sorted(notes) for username, notes in notes_db.items()}
+# Next id per user, never reused after a delete so cursors and cached ids stay valid
+next_note_ids = {username : max(notes, default=-1) + 1 for username, notes in notes_db.items()}
+note_revisions = {}
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -74,6 +116,146 @@ def authenticate_user(db, username : str, password : str):
     
     return user
 
+def tokenize(text : str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+def get_notes_index(username : str) -> dict:
+    if username not in notes_index:
+        notes_index[username] = {"postings" : {}, "lengths" : {}, "total_length" : 0}
+    return notes_index[username]
+
+def index_note(username : str, note : Note):
+    index = get_notes_index(username)
+    terms = tokenize(note.title) + tokenize(note.content)
+    for term, frequency in Counter(terms).items():
+        index["postings"].setdefault(term, {})[note.id] = frequency
+    index["lengths"][note.id] = len(terms)
+    index["total_length"] += len(terms)
+
+def unindex_note(username : str, note : Note):
+    index = get_notes_index(username)
+    for term in set(tokenize(note.title) + tokenize(note.content)):
+        postings = index["postings"].get(term)
+        if postings is None:
+            continue
+        postings.pop(note.id, None)
+        if not postings:
+            del index["postings"][term]
+    index["total_length"] -= index["lengths"].pop(note.id, 0)
+
+def make_snippet(text : str, terms : set[str]) -> str:
+    position = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        if match.group().lower() in terms:
+            position = match.start()
+            break
+    start = max(0, position - SNIPPET_LENGTH // 4)
+    snippet = text[start:start + SNIPPET_LENGTH]
+    if start > 0:
+        snippet = "..." + snippet
+    if start + SNIPPET_LENGTH < len(text):
+        snippet += "..."
+    return snippet
+
+def search_notes(username : str, query : str, limit : int) -> list[tuple[float, int]]:
+    index = get_notes_index(username)
+    notes_count = len(index["lengths"])
+    if notes_count == 0:
+        return []
+
+    average_length = index["total_length"] / notes_count or 1
+    scores = {}
+    for term in set(tokenize(query)):
+        postings = index["postings"].get(term)
+        if not postings:
+            continue
+        idf = math.log(1 + (notes_count - len(postings) + 0.5) / (len(postings) + 0.5))
+        for note_id, frequency in postings.items():
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * index["lengths"][note_id] / average_length)
+            scores[note_id] = scores.get(note_id, 0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+    return heapq.nlargest(limit, ((score, note_id) for note_id, score in scores.items()))
+
+def common_prefix_length(a : str, b : str) -> int:
+    # Bisects on slice comparisons, which run in C, instead of walking characters in Python
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def push_delta_op(ops : list, op):
+    # Merges runs of the same kind so a delta has one op per contiguous copy, skip or insert
+    if not op:
+        return
+    if ops and type(ops[-1]) is type(op) and (isinstance(op, str) or (ops[-1] > 0) == (op > 0)):
+        ops[-1] += op
+    else:
+        ops.append(op)
+
+def diff_delta_tokens(old_tokens : list, new_tokens : list, ops : list, patterns : tuple):
+    matcher = difflib.SequenceMatcher(None, old_tokens, new_tokens)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        old_part = "".join(old_tokens[i1:i2])
+        new_part = "".join(new_tokens[j1:j2])
+        if tag == "equal":
+            push_delta_op(ops, len(old_part))
+        elif tag == "replace" and patterns:
+            diff_delta_tokens(patterns[0].findall(old_part), patterns[0].findall(new_part), ops, patterns[1:])
+        else:
+            push_delta_op(ops, -len(old_part))
+            push_delta_op(ops, new_part)
+
+def make_delta(old : str, new : str) -> list:
+    # Positive ints copy from the old text, negative ints skip it, strings are inserted
+    # The shared prefix and suffix are cut off first, the rest is diffed by lines, changed lines by sentences and those by words,
+    # so a delta stays about as large as the edit rather than the note
+    prefix = common_prefix_length(old, new)
+    suffix = common_prefix_length(old[prefix:][::-1], new[prefix:][::-1])
+    old_middle = old[prefix:len(old) - suffix]
+    new_middle = new[prefix:len(new) - suffix]
+
+    ops = []
+    push_delta_op(ops, prefix)
+    diff_delta_tokens(DELTA_LINE_PATTERN.findall(old_middle), DELTA_LINE_PATTERN.findall(new_middle), ops, (DELTA_SENTENCE_PATTERN, DELTA_WORD_PATTERN))
+    push_delta_op(ops, suffix)
+    return ops
+
+def apply_delta(old : str, ops : list) -> str:
+    parts = []
+    position = 0
+    for op in ops:
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.append(old[position:position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(parts)
+
+def add_note_revision(username : str, note : Note, previous : Optional[Note] = None) -> int:
+    revisions = note_revisions.setdefault(username, {}).setdefault(note.id, [])
+    rev = len(revisions)
+    # Revisions are (updated_at, title, content): full text on checkpoints, deltas against the previous revision otherwise
+    if rev % REVISION_CHECKPOINT_INTERVAL == 0:
+        revisions.append((datetime.utcnow(), note.title, note.content))
+    else:
+        revisions.append((datetime.utcnow(), make_delta(previous.title, note.title), make_delta(previous.content, note.content)))
+    return rev
+
+def get_note_revision(username : str, note_id : int, rev : int) -> Note:
+    revisions = note_revisions[username][note_id]
+    checkpoint = rev - rev % REVISION_CHECKPOINT_INTERVAL
+    _, title, content = revisions[checkpoint]
+    for _, title_delta, content_delta in revisions[checkpoint + 1:rev + 1]:
+        title = apply_delta(title, title_delta)
+        content = apply_delta(content, content_delta)
+    return Note(id=note_id, title=title, content=content)
+
 def create_acces_token(data : dict, expires_delta : Optional[timedelta]):
     to_encode = data.copy()
     if expires_delta:
@@ -126,8 +308,10 @@ async def register_user(registerForm : RegisterUser):
         "username" : registerForm.username,
         "hashed_password" : hashed_password,
         "disabled" : False,
-        "notes" : {}
     }
+    notes_db[registerForm.username] = {}
+    note_ids[registerForm.username] = []
+    next_note_ids[registerForm.username] = 0
     
     return {"message" : "succesfully registered"}
 
@@ -138,18 +322,109 @@ async def read_users_me(current_user : User = Depends(get_current_active_user)):
 @app.post("/addnote")
 async def add_note_for_user(new_note : NoteCreate, current_user : User = Depends(get_current_active_user)):
     username = current_user.username
-    noteid = len(db[username]["notes"])
-    while noteid in db[username]["notes"]:
-        noteid += 1
-    
-    db[username]["notes"][noteid] = Note(id = noteid, **dict(new_note))
+    user_notes = notes_db.setdefault(username, {})
+    noteid = next_note_ids.get(username, 0)
+    next_note_ids[username] = noteid + 1
+    note = Note(id = noteid, **dict(new_note))
+    user_notes[noteid] = note.dict()
+    note_ids.setdefault(username, []).append(noteid)
+    index_note(username, note)
+    add_note_revision(username, note)
     return {"message" : "succesfully created note"}
 
 @app.delete("/deletenote/{note_id}")
 async def delete_note_for_user(note_id : int, current_user : User = Depends(get_current_active_user)):
     username = current_user.username
-    if note_id not in db[username]["notes"]:
+    user_notes = notes_db.get(username, {})
+    if note_id not in user_notes:
         raise HTTPException(status_code=404, detail=f"Not found note with id {note_id} for user")
     
-    del db[username]["notes"][note_id]
-    return {"message" : "succesfully deleted note"}
\ No newline at end of file
+    note = user_notes.pop(note_id)
+    ids = note_ids[username]
+    del ids[bisect.bisect_left(ids, note_id)]
+    unindex_note(username, Note(**note))
+    note_revisions.get(username, {}).pop(note_id, None)
+    return {"message" : "succesfully deleted note"}
+
+@app.get("/notes/search", response_model=list[NoteSearchResult])
+async def search_user_notes(q : str = Query(..., min_length=1), limit : int = Query(10, ge=1, le=100), current_user : User = Depends(get_current_active_user)):
+    username = current_user.username
+    terms = set(tokenize(q))
+    result = []
+    for score, note_id in search_notes(username, q, limit):
+        note = notes_db[username][note_id]
+        result.append(NoteSearchResult(score=round(score, 4), snippet=make_snippet(note["content"], terms), **note))
+    return result
+
+@app.get("/notes", response_model=NotesPage)
+async def get_user_notes(cursor : Optional[int] = None, limit : int = Query(20, ge=1, le=100), fields : Optional[str] = None, current_user : User = Depends(get_current_active_user)):
+    username = current_user.username
+    selected = NOTE_FIELDS
+    if fields is not None:
+        requested = {field.strip() for field in fields.split(",") if field.strip()}
+        if not requested <= set(NOTE_FIELDS):
+            raise HTTPException(status_code=400, detail=f"Unknown note fields {sorted(requested - set(NOTE_FIELDS))}")
+        selected = [field for field in NOTE_FIELDS if field == "id" or field in requested]
+
+    ids = note_ids.get(username, [])
+    start = 0 if cursor is None else bisect.bisect_right(ids, cursor)
+    page_ids = ids[start:start + limit]
+    user_notes = notes_db[username] if page_ids else {}
+    notes = [{field : user_notes[note_id][field] for field in selected} for note_id in page_ids]
+
+    next_cursor = None
+    if start + limit < len(ids):
+        next_cursor = page_ids[-1]
+    return {"notes" : notes, "next_cursor" : next_cursor}
+
+@app.get("/notes/{note_id}", response_model=Note)
+async def get_user_note(note_id : int, rev : Optional[int] = Query(None, ge=0), current_user : User = Depends(get_current_active_user)):
+    username = current_user.username
+    user_notes = notes_db.get(username, {})
+    if note_id not in user_notes:
+        raise HTTPException(status_code=404, detail=f"Not found note with id {note_id} for user")
+
+    if rev is None:
+        return user_notes[note_id]
+    if rev >= len(note_revisions[username][note_id]):
+        raise HTTPException(status_code=404, detail=f"Not found revision {rev} for note {note_id}")
+    return get_note_revision(username, note_id, rev)
+
+@app.put("/notes/{note_id}")
+async def update_user_note(note_id : int, form : NoteUpdate, current_user : User = Depends(get_current_active_user)):
+    username = current_user.username
+    user_notes = notes_db.get(username, {})
+    if note_id not in user_notes:
+        raise HTTPException(status_code=404, detail=f"Not found note with id {note_id} for user")
+
+    previous = Note(**user_notes[note_id])
+    note = Note(
+        id=note_id,
+        title=previous.title if form.title is None else form.title,
+        content=previous.content if form.content is None else form.content,
+    )
+    if note == previous:
+        return {"message" : "note is unchanged", "rev" : len(note_revisions[username][note_id]) - 1}
+
+    user_notes[note_id] = note.dict()
+    unindex_note(username, previous)
+    index_note(username, note)
+    rev = add_note_revision(username, note, previous)
+    return {"message" : "succesfully updated note", "rev" : rev}
+
+@app.get("/notes/{note_id}/revisions", response_model=list[NoteRevision])
+async def get_user_note_revisions(note_id : int, current_user : User = Depends(get_current_active_user)):
+    username = current_user.username
+    if note_id not in notes_db.get(username, {}):
+        raise HTTPException(status_code=404, detail=f"Not found note with id {note_id} for user")
+
+    revisions = note_revisions[username][note_id]
+    return [
+        {"rev" : rev, "updated_at" : updated_at, "checkpoint" : rev % REVISION_CHECKPOINT_INTERVAL == 0}
+        for rev, (updated_at, _, _) in enumerate(revisions)
+    ]
+
+for username, user_notes in notes_db.items():
+    for note in user_notes.values():
+        index_note(username, Note(**note))
+        add_note_revision(username, Note(**note))
\ No newline at end of file
@@ -1,10 +1,17 @@
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Optional
 from passlib.context import CryptContext
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from jose import jwt, JWTError
+import bisect
+import csv
+import heapq
+import io
+import json
+import zlib
 
 import jwtconfig
 
@@ -19,6 +26,7 @@ class ExpenseForm(BaseModel):
     amount : float
     category : Optional[str] = None
     description : Optional[str] = None
+    timestamp : datetime = Field(default_factory=datetime.utcnow)
 
 class Expense(ExpenseForm):
     id : int
@@ -27,22 +35,40 @@ class UpdateExpenseForm(BaseModel):
     amount : Optional[float] = None
     category : Optional[str] = None
     description : Optional[str] = None
+    timestamp : Optional[datetime] = None
 
 class UserRegistration(BaseModel):
     username : str
     password : str
     fullname : Optional[str] = None
 
-class User(BaseModel):
+class UserAccount(BaseModel):
     username : str = None
     fullname : Optional[str] = None
-    expenses : dict[int, Expense] = Field(default_factory=dict)
     disabled : Optional[bool] = False
 
-class UserInDB(User):
+class User(UserAccount):
+    expenses : dict[int, Expense] = Field(default_factory=dict)
+
+class UserInDB(UserAccount):
     hashed_password : str
 
 db = {}
+expense_stats = {}
+expense_timeline = {}
+expense_buckets = {}
+
+BUCKET_FORMATS = {
+    "day" : "%Y-%m-%d",
+    "month" : "%Y-%m",
+}
+
+EXPORT_FORMATS = {
+    "csv" : "text/csv",
+    "ndjson" : "application/x-ndjson",
+}
+EXPORT_FIELDS = ["id", "timestamp", "category", "amount", "description"]
+EXPORT_BATCH_SIZE = 1000
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -56,9 +82,15 @@ def get_password_hash(password : str) -> str:
     return pwd_context.hash(password)
 
 def get_user(db, username : str):
+    # Only the account fields are validated, expenses stay in db and are read by the routes that need them
     if username in db:
         user_data = db[username]
-        return UserInDB(**user_data)
+        return UserInDB(
+            username=user_data["username"],
+            fullname=user_data.get("fullname"),
+            disabled=user_data.get("disabled", False),
+            hashed_password=user_data["hashed_password"],
+        )
 
 def authenticate_user(db, username : str, password : str):
     user = get_user(db, username)
@@ -80,6 +112,136 @@ def create_access_token(data : dict, expires_delta : Optional[timedelta]):
     encoded_jwt = jwt.encode(to_encode, jwtconfig.SECRET_KEY, algorithm=jwtconfig.ALGORITHM)
     return encoded_jwt
 
+def get_category_stats(username : str, category : Optional[str]) -> dict:
+    user_stats = expense_stats.setdefault(username, {})
+    if category not in user_stats:
+        user_stats[category] = {"sum" : 0.0, "count" : 0, "min_heap" : [], "max_heap" : []}
+    return user_stats[category]
+
+def add_expense_to_stats(username : str, expense : Expense):
+    stats = get_category_stats(username, expense.category)
+    stats["sum"] += expense.amount
+    stats["count"] += 1
+    heapq.heappush(stats["min_heap"], (expense.amount, expense.id))
+    heapq.heappush(stats["max_heap"], (-expense.amount, expense.id))
+    compact_stats_heaps(username, expense.category, stats)
+
+def remove_expense_from_stats(username : str, expense : Expense):
+    # Heap entries are dropped lazily when they reach the top, see is_live_stats_entry
+    stats = get_category_stats(username, expense.category)
+    stats["sum"] -= expense.amount
+    stats["count"] -= 1
+    if stats["count"] == 0:
+        del expense_stats[username][expense.category]
+    else:
+        compact_stats_heaps(username, expense.category, stats)
+
+def compact_stats_heaps(username : str, category : Optional[str], stats : dict):
+    # Stale entries buried below the top would pile up with every update, rebuild once they outnumber the live ones
+    if max(len(stats["min_heap"]), len(stats["max_heap"])) <= 2 * stats["count"]:
+        return
+    live = {entry for entry in stats["min_heap"] if is_live_stats_entry(username, category, entry[0], entry[1])}
+    stats["min_heap"] = list(live)
+    heapq.heapify(stats["min_heap"])
+    stats["max_heap"] = [(-amount, expense_id) for amount, expense_id in live]
+    heapq.heapify(stats["max_heap"])
+
+def is_live_stats_entry(username : str, category : Optional[str], amount : float, expense_id : int) -> bool:
+    expense = db[username]["expenses"].get(expense_id)
+    return expense is not None and expense.category == category and expense.amount == amount
+
+def summarize_category(username : str, category : Optional[str]) -> dict:
+    stats = expense_stats[username][category]
+    min_heap = stats["min_heap"]
+    while not is_live_stats_entry(username, category, min_heap[0][0], min_heap[0][1]):
+        heapq.heappop(min_heap)
+    max_heap = stats["max_heap"]
+    while not is_live_stats_entry(username, category, -max_heap[0][0], max_heap[0][1]):
+        heapq.heappop(max_heap)
+
+    return {
+        "sum" : stats["sum"],
+        "count" : stats["count"],
+        "min" : min_heap[0][0],
+        "max" : -max_heap[0][0],
+    }
+
+def to_utc(timestamp : datetime) -> datetime:
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def index_expense(username : str, expense : Expense):
+    bisect.insort(expense_timeline.setdefault(username, []), (expense.timestamp, expense.id))
+    user_buckets = expense_buckets.setdefault(username, {granularity : {} for granularity in BUCKET_FORMATS})
+    for granularity, bucket_format in BUCKET_FORMATS.items():
+        bucket = user_buckets[granularity].setdefault(expense.timestamp.strftime(bucket_format), {})
+        totals = bucket.setdefault(expense.category, {"sum" : 0.0, "count" : 0})
+        totals["sum"] += expense.amount
+        totals["count"] += 1
+
+def unindex_expense(username : str, expense : Expense):
+    timeline = expense_timeline[username]
+    del timeline[bisect.bisect_left(timeline, (expense.timestamp, expense.id))]
+    user_buckets = expense_buckets[username]
+    for granularity, bucket_format in BUCKET_FORMATS.items():
+        key = expense.timestamp.strftime(bucket_format)
+        bucket = user_buckets[granularity][key]
+        totals = bucket[expense.category]
+        totals["sum"] -= expense.amount
+        totals["count"] -= 1
+        if totals["count"] == 0:
+            del bucket[expense.category]
+        if not bucket:
+            del user_buckets[granularity][key]
+
+def format_export_rows(rows : list[dict], format : str) -> str:
+    if format == "ndjson":
+        return "".join(json.dumps(row) + "\n" for row in rows)
+
+    buffer = io.StringIO()
+    csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS).writerows(rows)
+    return buffer.getvalue()
+
+async def export_expense_rows(username : str, format : str, start : tuple, end : tuple, category : Optional[str]):
+    if format == "csv":
+        yield ",".join(EXPORT_FIELDS) + "\r\n"
+
+    # The timeline can change between chunks, so every batch re-seeks from the last exported key
+    position = start
+    while True:
+        timeline = expense_timeline.get(username, [])
+        first = bisect.bisect_left(timeline, position)
+        last = bisect.bisect_right(timeline, end, lo=first)
+        batch = timeline[first:min(last, first + EXPORT_BATCH_SIZE)]
+        if not batch:
+            return
+
+        expenses = db[username]["expenses"]
+        rows = []
+        for timestamp, expense_id in batch:
+            expense = expenses[expense_id]
+            if category is not None and expense.category != category:
+                continue
+            rows.append({
+                "id" : expense_id,
+                "timestamp" : timestamp.isoformat(),
+                "category" : expense.category,
+                "amount" : expense.amount,
+                "description" : expense.description,
+            })
+        if rows:
+            yield format_export_rows(rows, format)
+        position = (batch[-1][0], batch[-1][1] + 1)
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
 async def get_current_user(token : str = Depends(oauth2_scheme)):
     credential_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
     try:
@@ -127,58 +289,101 @@ async def register_user(form : UserRegistration):
         "expenses" : {},
         "disabled" : False,
     }
+    expense_stats[form.username] = {}
+    expense_timeline[form.username] = []
+    expense_buckets[form.username] = {granularity : {} for granularity in BUCKET_FORMATS}
     return {"message" : "succesfully registered"}
 
 @app.get("/me", response_model=User)
-async def read_users_me(current_user : User = Depends(get_current_active_user)):
-    return current_user
+async def read_users_me(current_user : UserAccount = Depends(get_current_active_user)):
+    return {**current_user.dict(), "expenses" : db[current_user.username]["expenses"]}
 
 @app.get("/expenses")
-async def get_user_expenses(current_user : User = Depends(get_current_active_user)):
-    return current_user.expenses
+async def get_user_expenses(from_ : Optional[datetime] = Query(None, alias="from"), to : Optional[datetime] = Query(None), current_user : UserAccount = Depends(get_current_active_user)):
+    if from_ is None and to is None:
+        return db[current_user.username]["expenses"]
+
+    username = current_user.username
+    timeline = expense_timeline.get(username, [])
+    start = 0 if from_ is None else bisect.bisect_left(timeline, (to_utc(from_),))
+    end = len(timeline) if to is None else bisect.bisect_right(timeline, (to_utc(to), float("inf")))
+    expenses = db[username]["expenses"]
+    return {expense_id : expenses[expense_id] for _, expense_id in timeline[start:end]}
 
 @app.post("/expenses")
-async def add_new_expense(expense : ExpenseForm, current_user : User = Depends(get_current_active_user)):
+async def add_new_expense(expense : ExpenseForm, current_user : UserAccount = Depends(get_current_active_user)):
     expenseID = 0
     username = current_user.username
     while expenseID in db[username]["expenses"]:
         expenseID += 1
 
-    db[username]["expenses"][expenseID] = Expense(id=expenseID, **expense.dict())
+    new_expense = Expense(id=expenseID, **expense.dict())
+    new_expense.timestamp = to_utc(new_expense.timestamp)
+    db[username]["expenses"][expenseID] = new_expense
+    add_expense_to_stats(username, new_expense)
+    index_expense(username, new_expense)
     return {"message" : "succesfully created expense"}
 
 @app.put("/expenses/{expense_id}")
-async def update_user_expense(expense_id : int, new_expense : UpdateExpenseForm, current_user : User = Depends(get_current_active_user)):
+async def update_user_expense(expense_id : int, new_expense : UpdateExpenseForm, current_user : UserAccount = Depends(get_current_active_user)):
     username = current_user.username
     if expense_id not in db[username]["expenses"]:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No expense with id {expense_id} for username {username}")
     
     expense_data = db[username]["expenses"][expense_id]
+    remove_expense_from_stats(username, expense_data)
+    unindex_expense(username, expense_data)
     if new_expense.amount is not None:
         expense_data.amount = new_expense.amount
     if new_expense.category is not None:
         expense_data.category = new_expense.category
     if new_expense.description is not None:
         expense_data.description = new_expense.description
+    if new_expense.timestamp is not None:
+        expense_data.timestamp = to_utc(new_expense.timestamp)
+    add_expense_to_stats(username, expense_data)
+    index_expense(username, expense_data)
 
     return {"message" : "succesfully updated expense"}
 
 @app.delete("/expenses/{expense_id}")
-async def delete_user_expense(expense_id : int, current_user : User = Depends(get_current_active_user)):
+async def delete_user_expense(expense_id : int, current_user : UserAccount = Depends(get_current_active_user)):
     username = current_user.username
     if expense_id not in db[username]["expenses"]:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No expense with id {expense_id} for username {username}")
 
-    del db[username]["expenses"][expense_id]
+    expense_data = db[username]["expenses"].pop(expense_id)
+    remove_expense_from_stats(username, expense_data)
+    unindex_expense(username, expense_data)
     return {"message" : "succesfully deleted expense"}
 
 @app.get("/expenses/summary")
-async def summarize_user_expenses(current_user : User = Depends(get_current_active_user)):
-    result = {}
-    expenses = current_user.expenses
-    for expense in expenses:
-        if expenses[expense].category not in result:
-            result[expenses[expense].category] = expenses[expense].amount
-        else:
-            result[expenses[expense].category] += expenses[expense].amount
-    return result
\ No newline at end of file
+async def summarize_user_expenses(current_user : UserAccount = Depends(get_current_active_user)):
+    # Stats are only touched between awaits, so every write is applied atomically on the event loop
+    username = current_user.username
+    return {category : summarize_category(username, category) for category in expense_stats.get(username, {})}
+
+@app.get("/expenses/analytics")
+async def get_expense_analytics(granularity : str = Query("month"), current_user : UserAccount = Depends(get_current_active_user)):
+    if granularity not in BUCKET_FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Granularity must be one of {list(BUCKET_FORMATS)}")
+
+    buckets = expense_buckets.get(current_user.username, {}).get(granularity, {})
+    return {key : buckets[key] for key in sorted(buckets)}
+
+@app.get("/expenses/export")
+async def export_user_expenses(format : str = Query("csv"), gzip : bool = Query(False), from_ : Optional[datetime] = Query(None, alias="from"), to : Optional[datetime] = Query(None), category : Optional[str] = Query(None), current_user : UserAccount = Depends(get_current_active_user)):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Format must be one of {list(EXPORT_FORMATS)}")
+
+    start = (datetime.min,) if from_ is None else (to_utc(from_),)
+    end = (datetime.max, float("inf")) if to is None else (to_utc(to), float("inf"))
+    chunks = export_expense_rows(current_user.username, format, start, end, category)
+    filename = f"expenses.{format}"
+    media_type = EXPORT_FORMATS[format]
+    if gzip:
+        chunks = gzip_chunks(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+
+    return StreamingResponse(chunks, media_type=media_type, headers={"Content-Disposition" : f"attachment; filename={filename}"})
\ No newline at end of file
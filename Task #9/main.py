@@ -1,10 +1,13 @@
-from fastapi import FastAPI, HTTPException, status, Depends
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, status, Depends, Request, Query
+from pydantic import BaseModel, Field, ValidationError
 from typing import Optional
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
+import csv
+import json
+import math
 
 import jwtconfig
 
@@ -23,7 +26,9 @@ db = {
                         "description": "Milk and eggs",
                         "amount": 20,
                     },
-                ]
+                ],
+                "spent" : 20,
+                "purchases_count" : 1,
             }
         }
     }
@@ -46,21 +51,28 @@ class BudgetForm(BaseModel):
     
 class Budget(BudgetForm):
     purchases : list[Purchase] = Field(default_factory=list)
+    spent : float = 0
+    purchases_count : int = 0
 
 class UserRegistration(BaseModel):
     username : str
     password : str
     fullname : Optional[str] = None
 
-class User(BaseModel):
+class UserAccount(BaseModel):
     username : str = None
     full_name : Optional[str] = None
     disabled : Optional[bool] = False
+
+class User(UserAccount):
     budgets : dict[str, Budget] = Field(default_factory=dict)
 
-class UserInDB(User):
+class UserInDB(UserAccount):
     hashed_password : str
 
+BULK_FORMATS = ("csv", "ndjson")
+MAX_REPORTED_ERRORS = 100
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -73,9 +85,15 @@ def get_password_hash(password : str) -> str:
     return pwd_context.hash(password)
 
 def get_user(db, username : str):
+    # Only the account fields are validated, budgets and purchases stay in db and are read by the routes that need them
     if username in db:
         user_data = db[username]
-        return UserInDB(**user_data)
+        return UserInDB(
+            username=user_data["username"],
+            full_name=user_data.get("full_name"),
+            disabled=user_data.get("disabled", False),
+            hashed_password=user_data["hashed_password"],
+        )
 
 def authenticate_user(db, username : str, password : str):
     user = get_user(db, username)
@@ -97,6 +115,47 @@ def create_access_token(data : dict, expires_data : Optional[timedelta]):
     encoded_jwt = jwt.encode(to_encode, jwtconfig.SECRET_KEY, algorithm=jwtconfig.ALGORITHM)
     return encoded_jwt
 
+def record_purchase(budget_data : dict, amount : float, count : int = 1):
+    # Edits and deletes pass a negative amount/count to roll a purchase back out of the totals
+    budget_data["spent"] += amount
+    budget_data["purchases_count"] += count
+
+def get_budget_status(budget_data : dict) -> dict:
+    limit = budget_data["limit"]
+    spent = budget_data["spent"]
+    return {
+        "budget" : budget_data["budget"],
+        "limit" : limit,
+        "spent" : spent,
+        "remaining" : limit - spent,
+        "purchases" : budget_data["purchases_count"],
+        "status" : "OVER LIMIT" if spent > limit else "OK",
+    }
+
+async def read_body_lines(request : Request):
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode(errors="replace")
+    if pending:
+        yield pending.decode(errors="replace")
+
+def parse_purchase_row(line : str, format : str, header : Optional[list[str]]) -> tuple[str, Purchase]:
+    # Rows go through the same Purchase model as the single purchase endpoint, so nothing unvalidated reaches db
+    if format == "ndjson":
+        row = json.loads(line)
+    else:
+        row = dict(zip(header, next(csv.reader([line]))))
+    if not isinstance(row, dict) or not isinstance(row.get("budget"), str):
+        raise ValueError("budget must be a string")
+    purchase = Purchase(description=row.get("description") or "", amount=row.get("amount"))
+    if not math.isfinite(purchase.amount):
+        raise ValueError("amount must be a finite number")
+    return row["budget"], purchase
+
 async def get_current_user(token : str = Depends(oauth2_scheme)):
     credential_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
     try:
@@ -148,11 +207,11 @@ async def register_user(form : UserRegistration):
     return {"message" : "succesfully registrated"}
 
 @app.get("/me", response_model=User)
-async def read_users_me(current_user : User = Depends(get_current_active_user)):
-    return current_user
+async def read_users_me(current_user : UserInDB = Depends(get_current_active_user)):
+    return {**current_user.dict(), "budgets" : db[current_user.username]["budgets"]}
 
 @app.post("/budgets")
-async def add_new_budget(new_budget : BudgetForm, current_user : User = Depends(get_current_active_user)):
+async def add_new_budget(new_budget : BudgetForm, current_user : UserAccount = Depends(get_current_active_user)):
     budget = new_budget.budget
     username = current_user.username
     if budget in db[username]["budgets"]:
@@ -161,45 +220,81 @@ async def add_new_budget(new_budget : BudgetForm, current_user : User = Depends(
     db[username]["budgets"][budget] = {
         "budget" : budget,
         "limit" : new_budget.limit,
+        "purchases" : [],
+        "spent" : 0,
+        "purchases_count" : 0,
     }   
     return {"message" : "succesfully created budget"}
 
 @app.post("/budgets/{budget_name}/purchases")
-async def add_new_purchase(budget_name : str, new_purchase : Purchase, current_user : User = Depends(get_current_active_user)):
+async def add_new_purchase(budget_name : str, new_purchase : Purchase, current_user : UserAccount = Depends(get_current_active_user)):
     if budget_name not in db[current_user.username]["budgets"]:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Budget {budget_name} not found")
     
-    db[current_user.username]["budgets"][budget_name]["purchases"].append({
+    if not math.isfinite(new_purchase.amount):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Amount must be a finite number")
+
+    budget_data = db[current_user.username]["budgets"][budget_name]
+    budget_data["purchases"].append({
         "description" : new_purchase.description, "amount" : new_purchase.amount})
+    record_purchase(budget_data, new_purchase.amount)
     return {"message" : "succesfully created purchase"}
 
 @app.get("/budgets/{budget_name}/status")
-async def show_budget_status(budget_name : str, current_user : User = Depends(get_current_active_user)):
-    if budget_name not in db[current_user.username]["budgets"]:
+async def show_budget_status(budget_name : str, current_user : UserAccount = Depends(get_current_active_user)):
+    budgets = db[current_user.username]["budgets"]
+    if budget_name not in budgets:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Budget {budget_name} not found")
-    spent = 0
-    limit = db[current_user.username]["budgets"][budget_name]["limit"]
-    purchases = db[current_user.username]["budgets"][budget_name]["purchases"]
-    for purchase in purchases:
-        spent += purchase["amount"]
-
-    result = {
-        "budget" : budget_name,
-        "limit" : limit,
-        "spent" : spent,
-        "remaining" : limit - spent,
-    }
-    if spent > limit:
-        result["status"] = "OVER LIMIT"
-    else:
-        result["status"] = "OK"
 
-    return result
+    return get_budget_status(budgets[budget_name])
 
 @app.get("/budgets/overview")
-async def show_users_overview(current_user: User = Depends(get_current_active_user)):
-    result = []
-    for budget_name in db[current_user.username]["budgets"]:
-        budget_data = await show_budget_status(budget_name, current_user)
-        result.append(budget_data)
-    return result
\ No newline at end of file
+async def show_users_overview(current_user: UserAccount = Depends(get_current_active_user)):
+    return [get_budget_status(budget_data) for budget_data in db[current_user.username]["budgets"].values()]
+
+@app.post("/budgets/purchases/bulk")
+async def add_purchases_bulk(request : Request, format : str = Query("csv"), current_user : UserAccount = Depends(get_current_active_user)):
+    if format not in BULK_FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Format must be one of {list(BULK_FORMATS)}")
+
+    budgets = db[current_user.username]["budgets"]
+    header = None
+    accepted = 0
+    touched = {}
+    unknown_budgets = {}
+    errors = []
+    line_number = 0
+    async for line in read_body_lines(request):
+        line_number += 1
+        line = line.strip()
+        if not line:
+            continue
+        if format == "csv" and header is None:
+            header = [column.strip() for column in next(csv.reader([line]))]
+            continue
+
+        try:
+            budget_name, purchase = parse_purchase_row(line, format, header)
+        except (ValidationError, ValueError, StopIteration):
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line" : line_number, "error" : "invalid row"})
+            continue
+
+        budget_data = budgets.get(budget_name)
+        if budget_data is None:
+            unknown_budgets[budget_name] = unknown_budgets.get(budget_name, 0) + 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line" : line_number, "error" : f"Budget {budget_name} not found"})
+            continue
+
+        budget_data["purchases"].append({"description" : purchase.description, "amount" : purchase.amount})
+        record_purchase(budget_data, purchase.amount)
+        touched[budget_name] = budget_data
+        accepted += 1
+
+    return {
+        "accepted" : accepted,
+        "unknown_budgets" : unknown_budgets,
+        "errors" : errors,
+        "budgets" : [get_budget_status(budget_data) for budget_data in touched.values()],
+    }
\ No newline at end of file